@@ -11,9 +11,9 @@ import requests
 import consul
 import yaml
 try:
-    from yaml import CLoader as Loader
+    from yaml import CSafeLoader as SafeLoader
 except ImportError:
-    from yaml import Loader
+    from yaml import SafeLoader
 
 from biomaj_download.downloadservice import DownloadService
 from biomaj_core.utils import Utils
@@ -24,7 +24,7 @@ if 'BIOMAJ_CONFIG' in os.environ:
 
 config = None
 with open(config_file, 'r') as ymlfile:
-    config = yaml.load(ymlfile, Loader=Loader)
+    config = yaml.load(ymlfile, Loader=SafeLoader)
     Utils.service_config_override(config)
 
 
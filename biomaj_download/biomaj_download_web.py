@@ -5,15 +5,17 @@ Manage sessions and metrics
 
 import ssl
 import os
+import base64
 
 import yaml
 try:
-    from yaml import CLoader as Loader
+    from yaml import CSafeLoader as SafeLoader
 except ImportError:
-    from yaml import Loader
+    from yaml import SafeLoader
 from flask import Flask
 from flask import jsonify
 from flask import request
+from flask import Response
 from prometheus_client import Counter
 from prometheus_client.exposition import generate_latest
 from prometheus_client import multiprocess
@@ -22,6 +24,7 @@ import consul
 
 from biomaj_download.message import downmessage_pb2
 from biomaj_download.downloadservice import DownloadService
+from biomaj_download.downloadservice import get_consul_agent
 
 from biomaj_core.utils import Utils
 
@@ -38,13 +41,13 @@ if 'BIOMAJ_CONFIG' in os.environ:
 
 config = None
 with open(config_file, 'r') as ymlfile:
-    config = yaml.load(ymlfile, Loader=Loader)
+    config = yaml.load(ymlfile, Loader=SafeLoader)
     Utils.service_config_override(config)
 
 
 def consul_declare(config):
     if config['consul']['host']:
-        consul_agent = consul.Consul(host=config['consul']['host'])
+        consul_agent = get_consul_agent(config['consul']['host'])
         consul_agent.agent.service.register(
             'biomaj-download',
             service_id=config['consul']['id'],
@@ -58,7 +61,7 @@ def consul_declare(config):
                 'traefik-int.enable=true'
             ]
         )
-        check = consul.Check.http(url='http://' + config['web']['hostname'] + ':' + str(config['web']['port']) + '/api/download', interval=20)
+        check = consul.Check.http(url='http://' + config['web']['hostname'] + ':' + str(config['web']['port']) + '/api/download', interval=config['consul'].get('check_interval', 20))
         consul_agent.agent.check.register(config['consul']['id'] + '_check', check=check, service_id=config['consul']['id'])
 
 
@@ -141,7 +144,9 @@ def download_error(bank, session):
 @app.route('/api/download/list/<bank>/<session>')
 def list_result(bank, session):
     '''
-    Get file listing for bank and session, using FileList protobuf serialized string
+    Get file listing for bank and session, using FileList protobuf serialized string, base64 encoded
+
+    If client accepts application/x-protobuf, serialized message is sent as is
     '''
     dserv = DownloadService(config_file, rabbitmq=False)
     biomaj_file_info = downmessage_pb2.DownloadFile()
@@ -149,6 +154,10 @@ def list_result(bank, session):
     biomaj_file_info.session = session
     biomaj_file_info.local_dir = '/tmp'
     list_elts = dserv.list_result(biomaj_file_info, protobuf_decode=False)
+    if list_elts is not None and request.accept_mimetypes.best == 'application/x-protobuf':
+        return Response(list_elts, mimetype='application/x-protobuf')
+    if list_elts is not None:
+        list_elts = base64.b64encode(list_elts).decode('ascii')
     return jsonify({'files': list_elts})
 
 
@@ -493,7 +493,19 @@ class CurlDownload(DownloadInterface):
         rfiles = []
         rdirs = []
 
-        dirs = re.findall(self.http_parse.dir_line, result)
+        # Read parse settings once, http_parse may be a protobuf message
+        # whose fields are decoded on each access
+        http_parse = self.http_parse
+        dir_name = http_parse.dir_name - 1
+        dir_date = http_parse.dir_date - 1
+        file_name = http_parse.file_name - 1
+        file_size = http_parse.file_size
+        file_date = http_parse.file_date
+        file_date_format = None
+        if http_parse.file_date_format:
+            file_date_format = http_parse.file_date_format.replace('%%', '%')
+
+        dirs = re.findall(http_parse.dir_line, result)
         if dirs is not None and len(dirs) > 0:
             for founddir in dirs:
                 rfile = {}
@@ -501,31 +513,31 @@ class CurlDownload(DownloadInterface):
                 rfile['group'] = ''
                 rfile['user'] = ''
                 rfile['size'] = 0
-                date = founddir[self.http_parse.dir_date - 1]
+                date = founddir[dir_date]
                 dirdate = date.split()
                 parts = dirdate[0].split('-')
                 # 19-Jul-2014 13:02
                 rfile['month'] = Utils.month_to_num(parts[1])
                 rfile['day'] = int(parts[0])
                 rfile['year'] = int(parts[2])
-                rfile['name'] = founddir[self.http_parse.dir_name - 1]
+                rfile['name'] = founddir[dir_name]
                 rdirs.append(rfile)
 
-        files = re.findall(self.http_parse.file_line, result)
+        files = re.findall(http_parse.file_line, result)
         if files is not None and len(files) > 0:
             for foundfile in files:
                 rfile = {}
                 rfile['permissions'] = ''
                 rfile['group'] = ''
                 rfile['user'] = ''
-                if self.http_parse.file_size != -1:
-                    rfile['size'] = humanfriendly.parse_size(foundfile[self.http_parse.file_size - 1])
+                if file_size != -1:
+                    rfile['size'] = humanfriendly.parse_size(foundfile[file_size - 1])
                 else:
                     rfile['size'] = 0
-                if self.http_parse.file_date != -1:
-                    date = foundfile[self.http_parse.file_date - 1]
-                    if self.http_parse.file_date_format:
-                        date_object = datetime.strptime(date, self.http_parse.file_date_format.replace('%%', '%'))
+                if file_date != -1:
+                    date = foundfile[file_date - 1]
+                    if file_date_format:
+                        date_object = datetime.strptime(date, file_date_format)
                         rfile['month'] = date_object.month
                         rfile['day'] = date_object.day
                         rfile['year'] = date_object.year
@@ -542,7 +554,7 @@ class CurlDownload(DownloadInterface):
                     rfile['month'] = today.month
                     rfile['day'] = today.day
                     rfile['year'] = today.year
-                rfile['name'] = foundfile[self.http_parse.file_name - 1]
+                rfile['name'] = foundfile[file_name]
                 filehash = (rfile['name'] + str(date) + str(rfile['size'])).encode('utf-8')
                 rfile['hash'] = hashlib.md5(filehash).hexdigest()
                 rfiles.append(rfile)
@@ -2,8 +2,6 @@ from builtins import str
 
 import logging
 import threading
-import traceback
-import sys
 
 
 class DownloadThread(threading.Thread):
@@ -37,8 +35,7 @@ class DownloadThread(threading.Thread):
                     self.error += 1
                 self.files_to_download += 1
             except Exception as e:
-                logging.error("Download error: " + str(e))
-                traceback.print_exc(file=sys.stdout)
+                logging.exception("Download error: " + str(e))
                 self.error += 1
             self.queue.task_done()
             try:
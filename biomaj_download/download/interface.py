@@ -380,6 +380,7 @@ class DownloadInterface(object):
                         self._append_file_to_download(rfile)
                         self.logger.debug('Download:File:MatchRegExp:' + rfile['name'])
                     # return
+                subdir_re = re.compile(subdirs_pattern[0])
                 for direlt in dir_list:
                     subdir = direlt['name']
                     self.logger.debug('Download:File:Subdir:Check:' + subdir)
@@ -387,7 +388,7 @@ class DownloadInterface(object):
                         (subfile_list, subdirs_list) = self.list(prefix + '/' + subdir + '/')
                         self.match([pattern], subfile_list, subdirs_list, prefix + '/' + subdir, True)
                     else:
-                        if re.match(subdirs_pattern[0], subdir):
+                        if subdir_re.match(subdir):
                             self.logger.debug('Download:File:Subdir:Match:' + subdir)
                             # subdir match the beginning of the pattern
                             # check match in subdir
@@ -395,8 +396,9 @@ class DownloadInterface(object):
                             self.match(['/'.join(subdirs_pattern[1:])], subfile_list, subdirs_list, prefix + '/' + subdir, True)
 
             else:
+                pattern_re = re.compile(pattern)
                 for rfile in file_list:
-                    if re.match(pattern, rfile['name']):
+                    if pattern_re.match(rfile['name']):
                         if prefix != '':
                             rfile['name'] = prefix + '/' + rfile['name']
                         self._append_file_to_download(rfile)
@@ -1,8 +1,12 @@
 from biomaj_download.downloadservice import DownloadService
+from biomaj_download.downloadservice import rabbitmq_connection_parameters
+from biomaj_download.downloadservice import PROTOCOL_VALUES
+from biomaj_download.downloadservice import HTTP_METHOD_VALUES
 import requests
 import logging
 import uuid
 import time
+import threading
 from queue import Queue
 
 import pika
@@ -13,6 +17,10 @@ from biomaj_download.message import downmessage_pb2
 
 class DownloadClient(DownloadService):
 
+    # Delay bounds (seconds) between download status checks
+    STATUS_POLL_MIN = 1
+    STATUS_POLL_MAX = 10
+
     def __init__(self, rabbitmq_host=None, rabbitmq_port=5672, rabbitmq_vhost='/', rabbitmq_user=None, rabbitmq_password=None, pool_size=5, redis_client=None, redis_prefix=None):
         self.logger = logging
         self.channel = None
@@ -22,14 +30,12 @@ class DownloadClient(DownloadService):
         self.rate_limiting = 0
         self.redis_client = redis_client
         self.redis_prefix = redis_prefix
+        # DownloadService.__init__ is not called, ask_download() needs the publish lock
+        self.publish_lock = threading.Lock()
         if rabbitmq_host:
             self.remote = True
-            connection = None
-            if rabbitmq_user:
-                credentials = pika.PlainCredentials(rabbitmq_user, rabbitmq_password)
-                connection = pika.BlockingConnection(pika.ConnectionParameters(rabbitmq_host, rabbitmq_port, rabbitmq_vhost, credentials, heartbeat_interval=0))
-            else:
-                connection = pika.BlockingConnection(pika.ConnectionParameters(rabbitmq_host, rabbitmq_port, rabbitmq_vhost, heartbeat_interval=0))
+            # No heartbeat, connection is not serviced while waiting for downloads
+            connection = pika.BlockingConnection(rabbitmq_connection_parameters(rabbitmq_host, rabbitmq_port, rabbitmq_vhost, rabbitmq_user, rabbitmq_password))
             self.channel = connection.channel()
         else:
             self.remote = False
@@ -87,23 +93,38 @@ class DownloadClient(DownloadService):
         offline_dir = base dir to download files
 
         '''
+        remote_dir = cf.get('remote.dir')
+        if not remote_dir:
+            remote_dir = ''
+        timeout_download = cf.get('timeout.download', None)
+        if timeout_download:
+            try:
+                timeout_download = int(timeout_download)
+            except Exception:
+                logging.error('Invalid timeout value, not an integer, skipping')
+                timeout_download = None
         for downloader in downloaders:
+            if not downloader.files_to_download:
+                continue
+            # Fields common to all files of the downloader, copied in each operation
+            base_operation = downmessage_pb2.Operation()
+            base_operation.type = 1
+            message = base_operation.download
+            message.bank = self.bank
+            message.session = self.session
+            message.local_dir = offline_dir
+            message.remote_file.protocol = PROTOCOL_VALUES[downloader.protocol.lower()]
+            message.remote_file.server = downloader.server
+            message.remote_file.remote_dir = remote_dir
+            message.remote_file.credentials = downloader.credentials
+            message.http_method = HTTP_METHOD_VALUES[downloader.method.upper()]
+            if timeout_download:
+                message.timeout_download = timeout_download
+
             for file_to_download in downloader.files_to_download:
                 operation = downmessage_pb2.Operation()
-                operation.type = 1
-                message = downmessage_pb2.DownloadFile()
-                message.bank = self.bank
-                message.session = self.session
-                message.local_dir = offline_dir
-                remote_file = downmessage_pb2.DownloadFile.RemoteFile()
-                protocol = downloader.protocol
-                remote_file.protocol = downmessage_pb2.DownloadFile.Protocol.Value(protocol.upper())
-                remote_file.server = downloader.server
-                if cf.get('remote.dir'):
-                    remote_file.remote_dir = cf.get('remote.dir')
-                else:
-                    remote_file.remote_dir = ''
-                remote_file.credentials = downloader.credentials
+                operation.CopyFrom(base_operation)
+                remote_file = operation.download.remote_file
                 biomaj_file = remote_file.files.add()
                 biomaj_file.name = file_to_download['name']
                 if 'root' in file_to_download and file_to_download['root']:
@@ -132,17 +153,6 @@ class DownloadClient(DownloadService):
                 if 'md5' in file_to_download and file_to_download['md5']:
                     biomaj_file.metadata.md5 = file_to_download['md5']
 
-                message.http_method = downmessage_pb2.DownloadFile.HTTP_METHOD.Value(downloader.method.upper())
-
-                timeout_download = cf.get('timeout.download', None)
-                if timeout_download:
-                    try:
-                        message.timeout_download = int(timeout_download)
-                    except Exception:
-                        logging.error('Invalid timeout value, not an integer, skipping')
-
-                message.remote_file.MergeFrom(remote_file)
-                operation.download.MergeFrom(message)
                 self.download_remote_file(operation)
 
     def download_remote_file(self, operation):
@@ -189,8 +199,11 @@ class DownloadClient(DownloadService):
         nb_submitted = 0
         logging.info("Workflow:wf_download:RemoteDownload:Waiting")
         if self.remote:
+            self.flush_publish()
             download_error = False
             last_progress = 0
+            last_status = (0, 0)
+            poll_delay = self.STATUS_POLL_MIN
             while not over:
                 # Check for cancel request
                 if self.redis_client and self.redis_client.get(self.redis_prefix + ':' + self.bank + ':action:cancel'):
@@ -212,6 +225,7 @@ class DownloadClient(DownloadService):
                                 operation = self.download_pool.pop()
                                 self.ask_download(operation)
                                 nb_submitted += 1
+                        self.flush_publish()
 
                 if progress >= nb_files_to_download:
                     over = True
@@ -222,8 +236,14 @@ class DownloadClient(DownloadService):
                     if progress_percent > last_progress:
                         last_progress = progress_percent
                         logging.info("Workflow:wf_download:RemoteDownload:InProgress:" + str(progress) + '/' + str(nb_files_to_download) + "(" + str(progress_percent) + "%)")
-                    time.sleep(10)
-                if error > 0:
+                    # Poll again quickly while downloads progress, back off when idle
+                    if (progress, error) != last_status:
+                        poll_delay = self.STATUS_POLL_MIN
+                    else:
+                        poll_delay = min(poll_delay * 2, self.STATUS_POLL_MAX)
+                    time.sleep(poll_delay)
+                # Fetch error details only when new errors were reported
+                if error > 0 and error != last_status[1]:
                     download_error = True
                     r = requests.get(self.proxy + '/api/download/error/download/' + self.bank + '/' + self.session)
                     if not r.status_code == 200:
@@ -231,6 +251,7 @@ class DownloadClient(DownloadService):
                     result = r.json()
                     for err in result['error']:
                         logging.info("Workflow:wf_download:RemoteDownload:Errors:Info:" + str(err))
+                last_status = (progress, error)
             return download_error
         else:
             error = self._download_pool_files()
@@ -1,19 +1,22 @@
+import ast
 import os
-import datetime
+import time
 import logging
 import logging.config
 import yaml
 try:
-    from yaml import CLoader as Loader
+    from yaml import CSafeLoader as SafeLoader
 except ImportError:
-    from yaml import Loader
+    from yaml import SafeLoader
 import redis
 import uuid
-import traceback
 import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 import consul
 import pika
+from google.protobuf.internal import api_implementation
 from flask import Flask
 from flask import jsonify
 
@@ -34,10 +37,46 @@ app_log.setLevel(logging.ERROR)
 # Classify protocols from downmessage.proto
 # Note: those lists are based on the protocol numbers, not the protocol names
 ALL_PROTOCOLS = [item for key, item in downmessage_pb2.DownloadFile.Protocol.items()]
-DIRECT_PROTOCOLS = [
+DIRECT_PROTOCOLS = frozenset(
     item for key, item in downmessage_pb2.DownloadFile.Protocol.items()
     if key.startswith("DIRECT")
-]
+)
+# Lower case protocol names, indexed by protocol number (numbers are contiguous)
+PROTOCOL_NAMES = tuple(
+    key.lower() for key, item in sorted(downmessage_pb2.DownloadFile.Protocol.items(), key=lambda protocol: protocol[1])
+)
+# Protocol numbers, indexed by lower case protocol name
+PROTOCOL_VALUES = dict((key.lower(), item) for key, item in downmessage_pb2.DownloadFile.Protocol.items())
+# HTTP method names and numbers from downmessage.proto
+HTTP_METHOD_NAMES = dict((item, key) for key, item in downmessage_pb2.DownloadFile.HTTP_METHOD.items())
+HTTP_METHOD_VALUES = dict(downmessage_pb2.DownloadFile.HTTP_METHOD.items())
+
+# Redis keys of a session: prefix:bank:session:session_id[suffix]
+SESSION_KEY_SUFFIXES = ('', ':error', ':progress', ':files', ':error:info')
+
+# Number of error messages kept per session, latest first
+MAX_SESSION_ERRORS = 100
+
+# Record the end of a download if its session still exists, atomically
+# KEYS: session keys, in SESSION_KEY_SUFFIXES order
+# ARGV: 1 if download failed, error message, MAX_SESSION_ERRORS, session ttl (0 for none)
+END_DOWNLOAD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+if ARGV[1] == '1' then
+    redis.call('INCR', KEYS[2])
+    redis.call('LPUSH', KEYS[5], ARGV[2])
+    redis.call('LTRIM', KEYS[5], 0, tonumber(ARGV[3]) - 1)
+end
+redis.call('INCR', KEYS[3])
+if tonumber(ARGV[4]) > 0 then
+    for i = 1, #KEYS do
+        redis.call('EXPIRE', KEYS[i], ARGV[4])
+    end
+end
+return 1
+"""
 
 
 @app.route('/api/download-message')
@@ -46,12 +85,38 @@ def ping():
 
 
 def start_web(config):
-    app.run(host='0.0.0.0', port=config['web']['port'])
+    # Health checks must not wait behind other requests
+    app.run(host='0.0.0.0', port=config['web']['port'], threaded=True)
+
+
+def rabbitmq_connection_parameters(host, port=5672, virtual_host='/', user=None, password=None, heartbeat=0, tcp_options=None):
+    '''
+    Get rabbitmq connection parameters
+
+    :param heartbeat: heartbeat timeout in seconds, 0 disables heartbeats
+    :type heartbeat: int
+    :param tcp_options: socket options, see pika.ConnectionParameters
+    :type tcp_options: dict
+    '''
+    options = {'heartbeat_interval': heartbeat}
+    if user:
+        options['credentials'] = pika.PlainCredentials(user, password)
+    if tcp_options:
+        options['tcp_options'] = tcp_options
+    return pika.ConnectionParameters(host, port, virtual_host, **options)
+
+
+@functools.lru_cache(maxsize=None)
+def get_consul_agent(host):
+    '''
+    Get a consul client, shared for a given host
+    '''
+    return consul.Consul(host=host)
 
 
 def consul_declare(config):
     if config['consul']['host']:
-        consul_agent = consul.Consul(host=config['consul']['host'])
+        consul_agent = get_consul_agent(config['consul']['host'])
         consul_agent.agent.service.register(
             'biomaj-download-message',
             service_id=config['consul']['id'],
@@ -61,7 +126,7 @@ def consul_declare(config):
         )
         check = consul.Check.http(
             url='http://' + config['web']['hostname'] + ':' + str(config['web']['port']) + '/api/download-message',
-            interval=20
+            interval=config['consul'].get('check_interval', 20)
         )
         consul_agent.agent.check.register(
             config['consul']['id'] + '_check',
@@ -75,8 +140,32 @@ def consul_declare(config):
 
 class DownloadService(object):
 
+    # Downloader constructors, indexed by protocol number.
+    # Each factory takes (protocol_name, server, remote_dir, http_parse)
+    PROTOCOL_HANDLERS = {
+        0: lambda name, server, remote_dir, http_parse: CurlDownload(name, server, remote_dir),  # FTP
+        1: lambda name, server, remote_dir, http_parse: CurlDownload(name, server, remote_dir),  # FTPS
+        2: lambda name, server, remote_dir, http_parse: CurlDownload(name, server, remote_dir, http_parse),  # HTTP
+        3: lambda name, server, remote_dir, http_parse: CurlDownload(name, server, remote_dir, http_parse),  # HTTPS
+        4: lambda name, server, remote_dir, http_parse: DirectFTPDownload('ftp', server, '/'),  # DirectFTP
+        5: lambda name, server, remote_dir, http_parse: DirectHTTPDownload('http', server, '/'),  # DirectHTTP
+        6: lambda name, server, remote_dir, http_parse: DirectHTTPDownload('https', server, '/'),  # DirectHTTPS
+        7: lambda name, server, remote_dir, http_parse: LocalDownload(remote_dir),  # Local
+        8: lambda name, server, remote_dir, http_parse: RSYNCDownload(server, remote_dir),  # RSYNC
+        9: lambda name, server, remote_dir, http_parse: IRODSDownload(server, remote_dir),  # iRods
+        10: lambda name, server, remote_dir, http_parse: DirectFTPDownload('ftps', server, '/'),  # DirectFTPS
+    }
+
     channel = None
+    connection = None
+    executor = None
     redis_client = None
+    redis_binary_client = None
+    end_download_script = None
+    publish_batch_size = 0
+    publish_pending = 0
+    topology_declared = False
+    zipkin_configured = False
 
     def supervise(self):
         if consul_declare(self.config):
@@ -88,11 +177,17 @@ class DownloadService(object):
         self.session = None
         self.bank = None
         self.download_callback = None
+        # channel is shared by the publishers of this service
+        self.publish_lock = threading.Lock()
+        # Operation message reused by each worker thread
+        self.thread_data = threading.local()
         with open(config_file, 'r') as ymlfile:
-            self.config = yaml.load(ymlfile, Loader=Loader)
+            self.config = yaml.load(ymlfile, Loader=SafeLoader)
             Utils.service_config_override(self.config)
 
-        Zipkin.set_config(self.config)
+        if not DownloadService.zipkin_configured:
+            Zipkin.set_config(self.config)
+            DownloadService.zipkin_configured = True
 
         if 'log_config' in self.config:
             for handler in list(self.config['log_config']['handlers'].keys()):
@@ -105,22 +200,43 @@ class DownloadService(object):
                                                   port=self.config['redis']['port'],
                                                   db=self.config['redis']['db'],
                                                   decode_responses=True)
+        if not self.end_download_script:
+            self.end_download_script = self.redis_client.register_script(END_DOWNLOAD_SCRIPT)
+        if not self.redis_binary_client:
+            # Serialized protobuf messages are not utf-8 strings
+            self.redis_binary_client = redis.StrictRedis(host=self.config['redis']['host'],
+                                                         port=self.config['redis']['port'],
+                                                         db=self.config['redis']['db'],
+                                                         decode_responses=False)
 
         if rabbitmq and not self.channel:
-            connection = None
-            rabbitmq_port = self.config['rabbitmq']['port']
-            rabbitmq_user = self.config['rabbitmq']['user']
-            rabbitmq_password = self.config['rabbitmq']['password']
-            rabbitmq_vhost = self.config['rabbitmq']['virtual_host']
-            if rabbitmq_user:
-                credentials = pika.PlainCredentials(rabbitmq_user, rabbitmq_password)
-                connection = pika.BlockingConnection(pika.ConnectionParameters(self.config['rabbitmq']['host'], rabbitmq_port, rabbitmq_vhost, credentials, heartbeat_interval=0))
-            else:
-                connection = pika.BlockingConnection(pika.ConnectionParameters(self.config['rabbitmq']['host'], heartbeat_interval=0))
+            tcp_options = None
+            if self.config['rabbitmq'].get('tcp_keepalive'):
+                tcp_options = {'TCP_KEEPIDLE': self.config['rabbitmq']['tcp_keepalive']}
+            # Operations run in the worker pool, connection thread is free to answer heartbeats
+            connection = pika.BlockingConnection(rabbitmq_connection_parameters(
+                self.config['rabbitmq']['host'],
+                self.config['rabbitmq']['port'],
+                self.config['rabbitmq']['virtual_host'],
+                self.config['rabbitmq']['user'],
+                self.config['rabbitmq']['password'],
+                heartbeat=self.config['rabbitmq'].get('heartbeat', 0),
+                tcp_options=tcp_options
+            ))
+            self.connection = connection
             self.channel = connection.channel()
             self.logger.info('Download service started')
 
     def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+            try:
+                # Run acks scheduled by the workers and send remaining ones
+                self.connection.process_data_events(time_limit=0)
+                self._flush_acks()
+            except Exception as e:
+                logging.warn('Download:Service:Exception:' + str(e))
         if self.channel:
             try:
                 self.channel.close()
@@ -135,38 +251,20 @@ class DownloadService(object):
                     proxy=None, proxy_auth='',
                     save_as=None, timeout_download=None, offline_dir=None,
                     options={}):
-        protocol = downmessage_pb2.DownloadFile.Protocol.Value(protocol_name.upper())
-        downloader = None
-        if protocol in [0, 1]:  # FTP, SFTP
-            downloader = CurlDownload(protocol_name, server, remote_dir)
-        if protocol in [2, 3]:  # HTTP, HTTPS (could be factored with previous case)
-            downloader = CurlDownload(protocol_name, server, remote_dir, http_parse)
-        if protocol == 4:  # DirectFTP
-            downloader = DirectFTPDownload("ftp", server, '/')
-        if protocol == 5:  # DirectHTTP
-            downloader = DirectHTTPDownload("http", server, '/')
-        if protocol == 6:  # DirectHTTPS
-            downloader = DirectHTTPDownload("https", server, '/')
-        if protocol == 10:  # DirectFTPS
-            downloader = DirectFTPDownload('ftps', server, '/')
-        if protocol == 7:  # Local
-            downloader = LocalDownload(remote_dir)
-        if protocol == 8:  # RSYNC
-            downloader = RSYNCDownload(server, remote_dir)
-        if protocol == 9:  # iRods
-            downloader = IRODSDownload(server, remote_dir)
-        if downloader is None:
+        protocol = PROTOCOL_VALUES.get(protocol_name.lower())
+        if protocol is None:
+            raise ValueError('Unknown protocol %s' % (protocol_name))
+        handler_factory = self.PROTOCOL_HANDLERS.get(protocol)
+        if handler_factory is None:
             return None
+        downloader = handler_factory(protocol_name, server, remote_dir, http_parse)
 
         for remote_file in remote_files:
             if remote_file['save_as']:
                 save_as = remote_file['save_as']
         # For direct protocols, we only keep base name
         if protocol in DIRECT_PROTOCOLS:
-            tmp_remote = []
-            for remote_file in remote_files:
-                tmp_remote.append(remote_file['name'])
-            remote_files = tmp_remote
+            remote_files = [remote_file['name'] for remote_file in remote_files]
 
         if http_method is not None:
             downloader.set_method(http_method)
@@ -207,23 +305,26 @@ class DownloadService(object):
         Get a protocol download handler
         """
 
-        protocol = biomaj_file_info.remote_file.protocol
-        server = biomaj_file_info.remote_file.server
-        remote_dir = biomaj_file_info.remote_file.remote_dir
+        # Nested message accessors are not free, read remote_file once
+        remote_info = biomaj_file_info.remote_file
+        protocol = remote_info.protocol
+        server = remote_info.server
+        remote_dir = remote_info.remote_dir
 
-        protocol_name = downmessage_pb2.DownloadFile.Protocol.Name(protocol).lower()
+        protocol_name = PROTOCOL_NAMES[protocol]
         self.logger.debug('%s request to download from %s://%s' % (biomaj_file_info.bank, protocol_name, server))
 
-        remote_files = []
-        for remote_file in biomaj_file_info.remote_file.files:
-            remote_files.append({
-                                'name': remote_file.name,
-                                'save_as': remote_file.save_as,
-                                'year': remote_file.metadata.year,
-                                'month': remote_file.metadata.month,
-                                'day': remote_file.metadata.day,
-                                'root': remote_file.root
-                                })
+        remote_files = [
+            {
+                'name': remote_file.name,
+                'save_as': remote_file.save_as,
+                'year': remote_file.metadata.year,
+                'month': remote_file.metadata.month,
+                'day': remote_file.metadata.day,
+                'root': remote_file.root
+            }
+            for remote_file in remote_info.files
+        ]
 
         proxy = None
         proxy_auth = ''
@@ -232,19 +333,19 @@ class DownloadService(object):
             proxy_auth = biomaj_file_info.proxy.proxy_auth
 
         params = None
-        if biomaj_file_info.remote_file.param:
+        if remote_info.param:
             params = {}
-            for param in biomaj_file_info.remote_file.param:
+            for param in remote_info.param:
                 params[param.name] = param.value
         return self.get_handler(protocol_name, server, remote_dir,
                                 remote_files=remote_files,
-                                credentials=biomaj_file_info.remote_file.credentials,
-                                http_parse=biomaj_file_info.remote_file.http_parse,
-                                http_method=downmessage_pb2.DownloadFile.HTTP_METHOD.Name(biomaj_file_info.http_method),
+                                credentials=remote_info.credentials,
+                                http_parse=remote_info.http_parse,
+                                http_method=HTTP_METHOD_NAMES[biomaj_file_info.http_method],
                                 param=params,
                                 proxy=proxy,
                                 proxy_auth=proxy_auth,
-                                save_as=biomaj_file_info.remote_file.save_as,
+                                save_as=remote_info.save_as,
                                 timeout_download=biomaj_file_info.timeout_download,
                                 offline_dir=biomaj_file_info.local_dir,
                                 options=biomaj_file_info.options
@@ -261,40 +362,63 @@ class DownloadService(object):
             bank = biomaj_file_info.bank
 
         self.logger.debug('Clean %s session %s' % (bank, session))
-        self.redis_client.delete(self.config['redis']['prefix'] + ':' + bank + ':session:' + session)
-        self.redis_client.delete(self.config['redis']['prefix'] + ':' + bank + ':session:' + session + ':error')
-        self.redis_client.delete(self.config['redis']['prefix'] + ':' + bank + ':session:' + session + ':progress')
-        self.redis_client.delete(self.config['redis']['prefix'] + ':' + bank + ':session:' + session + ':files')
-        self.redis_client.delete(self.config['redis']['prefix'] + ':' + bank + ':session:' + session + ':error:info')
+        session_key = self._session_key(bank, session)
+        self.redis_client.delete(*[session_key + suffix for suffix in SESSION_KEY_SUFFIXES])
+
+    def _session_key(self, bank, session):
+        '''
+        Base redis key of a session, other session keys add a suffix to it
+        '''
+        return self.config['redis']['prefix'] + ':' + bank + ':session:' + session
 
     def _create_session(self, bank):
         '''
         Creates a unique session
         '''
         self.session = str(uuid.uuid4())
-        self.redis_client.set(self.config['redis']['prefix'] + ':' + bank + ':session:' + self.session, 1)
+        self.redis_client.set(self._session_key(bank, self.session), 1, ex=self.config['redis'].get('session_ttl', 0) or None)
         self.logger.debug('Create %s new session %s' % (bank, self.session))
         self.bank = bank
         return self.session
 
+    def _refresh_session(self, pipeline, session_key):
+        '''
+        Extend session keys expiration, sessions in progress or polled by
+        a client never expire while sessions whose clean() is never called
+        are dropped by redis
+        '''
+        session_ttl = self.config['redis'].get('session_ttl', 0)
+        if not session_ttl:
+            return
+        for suffix in SESSION_KEY_SUFFIXES:
+            pipeline.expire(session_key + suffix, session_ttl)
+
     def download_errors(self, biomaj_file_info):
         '''
         Get errors
         '''
-        errors = []
-        error = self.redis_client.rpop(self.config['redis']['prefix'] + ':' + biomaj_file_info.bank + ':session:' + biomaj_file_info.session + ':error:info')
-        while error:
-            errors.append(error)
-            error = self.redis_client.rpop(self.config['redis']['prefix'] + ':' + biomaj_file_info.bank + ':session:' + biomaj_file_info.session + ':error:info')
+        error_key = self._session_key(biomaj_file_info.bank, biomaj_file_info.session) + ':error:info'
+        pipeline = self.redis_client.pipeline()
+        pipeline.lrange(error_key, 0, -1)
+        pipeline.delete(error_key)
+        (errors, _) = pipeline.execute()
+        # errors are pushed on the left, return oldest first
+        errors.reverse()
         return errors
 
     def download_status(self, biomaj_file_info):
         '''
         Get current status
         '''
-
-        error = self.redis_client.get(self.config['redis']['prefix'] + ':' + biomaj_file_info.bank + ':session:' + biomaj_file_info.session + ':error')
-        progress = self.redis_client.get(self.config['redis']['prefix'] + ':' + biomaj_file_info.bank + ':session:' + biomaj_file_info.session + ':progress')
+        session_key = self._session_key(biomaj_file_info.bank, biomaj_file_info.session)
+        pipeline = self.redis_client.pipeline()
+        pipeline.mget(
+            session_key + ':error',
+            session_key + ':progress'
+        )
+        # A download may not end before session_ttl, client polling keeps the session
+        self._refresh_session(pipeline, session_key)
+        (error, progress) = pipeline.execute()[0]
         if error is None:
             error = -1
         if progress is None:
@@ -303,7 +427,11 @@ class DownloadService(object):
 
     def list_status(self, biomaj_file_info):
 
-        list_progress = self.redis_client.get(self.config['redis']['prefix'] + ':' + biomaj_file_info.bank + ':session:' + biomaj_file_info.session + ':progress')
+        session_key = self._session_key(biomaj_file_info.bank, biomaj_file_info.session)
+        pipeline = self.redis_client.pipeline()
+        pipeline.get(session_key + ':progress')
+        self._refresh_session(pipeline, session_key)
+        list_progress = pipeline.execute()[0]
         if list_progress:
             return True
         else:
@@ -312,19 +440,30 @@ class DownloadService(object):
     def list_result(self, biomaj_file_info, protobuf_decode=True):
         '''
         Get file list result
+
+        :return: FileList message, or its serialized bytes if protobuf_decode is False, None if not available
         '''
 
-        file_list = self.redis_client.get(self.config['redis']['prefix'] + ':' + biomaj_file_info.bank + ':session:' + biomaj_file_info.session + ':files')
+        file_list = self.redis_binary_client.get(self._session_key(biomaj_file_info.bank, biomaj_file_info.session) + ':files')
+        if file_list is None:
+            return None
+        if file_list.startswith((b"b'", b'b"')):
+            # Stored by 3.2.11 and before as str() of the serialized message.
+            # A serialized FileList starts with the tag of its files field (\n).
+            file_list = ast.literal_eval(file_list.decode('utf-8'))
         if protobuf_decode:
             file_list_pb2 = downmessage_pb2.FileList()
-            file_list_pb2.ParseFromString(file_list_pb2)
+            file_list_pb2.ParseFromString(file_list)
             return file_list_pb2
 
         return file_list
 
-    def _list(self, download_handler, biomaj_file_info):
+    def _list(self, download_handler, biomaj_file_info, pipeline=None):
         '''
         List remote content, no session management
+
+        :param pipeline: optional redis pipeline to record errors in, executed by caller
+        :type pipeline: redis.client.Pipeline
         '''
         file_list = []
         dir_list = []
@@ -335,8 +474,11 @@ class DownloadService(object):
             download_handler.match(biomaj_file_info.remote_file.matches, file_list, dir_list)
         except Exception as e:
             self.logger.error('List exception for bank %s: %s' % (biomaj_file_info.bank, str(e)))
-            self.redis_client.set(self.config['redis']['prefix'] + ':' + biomaj_file_info.bank + ':session:' + biomaj_file_info.session + ':error', 1)
-            self.redis_client.lpush(self.config['redis']['prefix'] + ':' + biomaj_file_info.bank + ':session:' + biomaj_file_info.session + ':error:info', str(e))
+            session_key = self._session_key(biomaj_file_info.bank, biomaj_file_info.session)
+            redis_writer = self.redis_client if pipeline is None else pipeline
+            redis_writer.set(session_key + ':error', 1)
+            redis_writer.lpush(session_key + ':error:info', str(e))
+            redis_writer.ltrim(session_key + ':error:info', 0, MAX_SESSION_ERRORS - 1)
         else:
             self.logger.debug('End of download for %s session %s' % (biomaj_file_info.bank, biomaj_file_info.session))
             for file_elt in download_handler.files_to_download:
@@ -352,7 +494,7 @@ class DownloadService(object):
                         param = file_list_pb2.param.add()
                         param.name = key
                         param.value = file_elt['param'][key]
-                metadata = downmessage_pb2.File.MetaData()
+                metadata = file_pb2.metadata
                 metadata.permissions = file_elt['permissions']
                 metadata.group = file_elt['group']
                 metadata.size = int(file_elt['size'])
@@ -362,7 +504,6 @@ class DownloadService(object):
                 metadata.day = int(file_elt['day'])
                 if 'format' in file_elt:
                     metadata.format = file_elt['format']
-                file_pb2.metadata.MergeFrom(metadata)
         return file_list_pb2
 
     def list(self, biomaj_file_info):
@@ -370,26 +511,40 @@ class DownloadService(object):
         List remote content
         '''
         self.logger.debug('New list request %s session %s' % (biomaj_file_info.bank, biomaj_file_info.session))
-        session = self.redis_client.get(self.config['redis']['prefix'] + ':' + biomaj_file_info.bank + ':session:' + biomaj_file_info.session)
+        session_key = self._session_key(biomaj_file_info.bank, biomaj_file_info.session)
+        session = self.redis_client.get(session_key)
         if not session:
             self.logger.debug('Session %s for bank %s has expired, skipping download of %s' % (biomaj_file_info.session, biomaj_file_info.bank, biomaj_file_info.remote_file.files))
             return
         download_handler = self._get_handler(biomaj_file_info)
+        pipeline = self.redis_client.pipeline()
         if download_handler is None:
             self.logger.error('Could not get a handler for %s with session %s' % (biomaj_file_info.bank, biomaj_file_info.session))
+            pipeline.set(session_key + ':error', 1)
+            pipeline.lpush(session_key + ':error:info', 'No handler for protocol')
+            pipeline.ltrim(session_key + ':error:info', 0, MAX_SESSION_ERRORS - 1)
+            pipeline.incr(session_key + ':progress')
+            self._refresh_session(pipeline, session_key)
+            pipeline.execute()
+            return
 
-        file_list_pb2 = self._list(download_handler, biomaj_file_info)
+        file_list_pb2 = self._list(download_handler, biomaj_file_info, pipeline)
 
-        self.redis_client.set(self.config['redis']['prefix'] + ':' + biomaj_file_info.bank + ':session:' + biomaj_file_info.session + ':files', str(file_list_pb2.SerializeToString()))
-        self.redis_client.incr(self.config['redis']['prefix'] + ':' + biomaj_file_info.bank + ':session:' + biomaj_file_info.session + ':progress')
+        pipeline.set(session_key + ':files', file_list_pb2.SerializeToString())
+        pipeline.incr(session_key + ':progress')
+        self._refresh_session(pipeline, session_key)
+        pipeline.execute()
 
     def local_download(self, biomaj_file_info):
         '''
         Download files, no session
+
+        Returns None if no handler is available for the protocol
         '''
         download_handler = self._get_handler(biomaj_file_info)
         if download_handler is None:
             self.logger.error('Could not get a handler for %s with session %s' % (biomaj_file_info.bank, biomaj_file_info.session))
+            return None
         downloaded_files = download_handler.download(biomaj_file_info.local_dir)
         self.logger.debug("Downloaded " + str(len(downloaded_files)) + " file in " + biomaj_file_info.local_dir)
         self.get_file_info(biomaj_file_info.local_dir, downloaded_files)
@@ -405,61 +560,117 @@ class DownloadService(object):
         '''
 
         self.logger.debug('New download request %s session %s' % (biomaj_file_info.bank, biomaj_file_info.session))
-        session = self.redis_client.get(self.config['redis']['prefix'] + ':' + biomaj_file_info.bank + ':session:' + biomaj_file_info.session)
+        session_key = self._session_key(biomaj_file_info.bank, biomaj_file_info.session)
+        session = self.redis_client.get(session_key)
         if not session:
             self.logger.debug('Session %s for bank %s has expired, skipping download of %s' % (biomaj_file_info.session, biomaj_file_info.bank, biomaj_file_info.remote_file.files))
             return
         downloaded_files = []
+        download_error = None
         try:
             downloaded_files = self.local_download(biomaj_file_info)
         except Exception as e:
             self.logger.exception("Download error:%s:%s:%s" % (biomaj_file_info.bank, biomaj_file_info.session, str(e)))
-            session = self.redis_client.get(self.config['redis']['prefix'] + ':' + biomaj_file_info.bank + ':session:' + biomaj_file_info.session)
-            if session:
-                # If session deleted, do not track
-                self.redis_client.incr(self.config['redis']['prefix'] + ':' + biomaj_file_info.bank + ':session:' + biomaj_file_info.session + ':error')
-                self.redis_client.lpush(self.config['redis']['prefix'] + ':' + biomaj_file_info.bank + ':session:' + biomaj_file_info.session + ':error:info', str(e))
+            download_error = str(e)
         else:
-            self.logger.debug('End of download for %s session %s' % (biomaj_file_info.bank, biomaj_file_info.session))
-
-        session = self.redis_client.get(self.config['redis']['prefix'] + ':' + biomaj_file_info.bank + ':session:' + biomaj_file_info.session)
-        if session:
-            # If session deleted, do not track
-            self.redis_client.incr(self.config['redis']['prefix'] + ':' + biomaj_file_info.bank + ':session:' + biomaj_file_info.session + ':progress')
+            if downloaded_files is None:
+                # No handler, error already logged
+                download_error = 'No handler for protocol'
+                downloaded_files = []
+            else:
+                self.logger.debug('End of download for %s session %s' % (biomaj_file_info.bank, biomaj_file_info.session))
+
+        # If session deleted, do not track, checked in the same script
+        self.end_download_script(
+            keys=[session_key + suffix for suffix in SESSION_KEY_SUFFIXES],
+            args=[
+                0 if download_error is None else 1,
+                download_error or '',
+                MAX_SESSION_ERRORS,
+                self.config['redis'].get('session_ttl', 0) or 0
+            ]
+        )
         return downloaded_files
 
     def get_file_info(self, local_dir, downloaded_files):
         if downloaded_files is None:
             return
+        # save_as may start with a /, so concatenate instead of os.path.join
+        # which would drop local_dir
+        dir_prefix = local_dir + '/'
         for downloaded_file in downloaded_files:
-            # file_dir = local_dir + '/' + os.path.dirname(downloaded_file['save_as'])
-            file_path = local_dir + '/' + downloaded_file['save_as']
-            fstat = os.stat(file_path)
+            fstat = os.stat(dir_prefix + downloaded_file['save_as'])
             downloaded_file['permissions'] = str(fstat.st_mode)
             downloaded_file['group'] = str(fstat.st_gid)
             downloaded_file['user'] = str(fstat.st_uid)
             downloaded_file['size'] = str(fstat.st_size)
-            fstat_mtime = datetime.datetime.fromtimestamp(fstat.st_mtime)
-            downloaded_file['month'] = fstat_mtime.month
-            downloaded_file['day'] = fstat_mtime.day
-            downloaded_file['year'] = fstat_mtime.year
+            fstat_mtime = time.localtime(fstat.st_mtime)
+            downloaded_file['month'] = fstat_mtime.tm_mon
+            downloaded_file['day'] = fstat_mtime.tm_mday
+            downloaded_file['year'] = fstat_mtime.tm_year
 
-    def ask_download(self, biomaj_info_file):
-        self.channel.basic_publish(
-            exchange='',
-            routing_key='biomajdownload',
-            body=biomaj_info_file.SerializeToString(),
-            properties=pika.BasicProperties(
-                # make message persistent
-                delivery_mode=2
-            ))
+    def set_publish_batch_size(self, size):
+        '''
+        Publish download requests in transactions of size messages
 
-    def callback_messages(self, ch, method, properties, body):
+        Messages are only guaranteed to be accepted by rabbitmq once the
+        transaction is committed, every size messages or on flush_publish().
+        Once enabled, batching cannot be disabled as the channel stays in
+        transaction mode.
+
+        :param size: number of messages per transaction, 1 or less to publish without transaction
+        :type size: int
         '''
-        Manage download and send ACK message
+        with self.publish_lock:
+            if size <= 1 and self.publish_batch_size > 1:
+                raise ValueError('Publish batching cannot be disabled, channel is in transaction mode')
+            if self.publish_batch_size > 1:
+                # Commit messages published with the previous size
+                self._commit_publish()
+            elif size > 1:
+                self.channel.tx_select()
+            self.publish_batch_size = size
+
+    def flush_publish(self):
+        '''
+        Commit pending published messages
+        '''
+        with self.publish_lock:
+            self._commit_publish()
+
+    def _commit_publish(self):
+        if self.publish_batch_size > 1 and self.publish_pending > 0:
+            self.channel.tx_commit()
+            self.publish_pending = 0
+
+    def ask_download(self, biomaj_info_file):
+        body = biomaj_info_file.SerializeToString()
+        # channel is not thread safe, publish one message at a time
+        with self.publish_lock:
+            self.channel.basic_publish(
+                exchange='',
+                routing_key='biomajdownload',
+                body=body,
+                properties=pika.BasicProperties(
+                    # make message persistent
+                    delivery_mode=2
+                ))
+            if self.publish_batch_size > 1:
+                self.publish_pending += 1
+                if self.publish_pending >= self.publish_batch_size:
+                    self._commit_publish()
+
+    def _process_message(self, body):
+        '''
+        Manage a list or download operation
         '''
         try:
-            operation = downmessage_pb2.Operation()
+            # Reuse the operation message of the worker thread,
+            # ParseFromString clears previous content
+            operation = getattr(self.thread_data, 'operation', None)
+            if operation is None:
+                operation = downmessage_pb2.Operation()
+                self.thread_data.operation = operation
             operation.ParseFromString(body)
             message = operation.download
             span = None
@@ -488,16 +699,110 @@ class DownloadService(object):
             if span:
                 span.trace()
         except Exception as e:
-            self.logger.error('Error with message: %s' % (str(e)))
-            traceback.print_exc()
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+            self.logger.exception('Error with message: %s' % (str(e)))
+
+    def _ack_message(self, ch, delivery_tag):
+        '''
+        Send ACK message from a worker thread, channel is only used in the connection thread
+        '''
+        self.connection.add_callback_threadsafe(functools.partial(self._message_done, ch, delivery_tag))
+
+    def _message_done(self, ch, delivery_tag):
+        '''
+        Mark a message as processed, runs in the connection thread
+
+        With rabbitmq.ack_batch_size > 1, processed messages are acked together
+        once ack_batch_size are pending or after rabbitmq.ack_delay seconds.
+        '''
+        self._running_tags.discard(delivery_tag)
+        if self.ack_batch_size <= 1:
+            ch.basic_ack(delivery_tag=delivery_tag)
+            return
+        self._processed_tags.add(delivery_tag)
+        if len(self._processed_tags) >= self.ack_batch_size:
+            self._flush_acks()
+        elif self._ack_timer is None:
+            self._ack_timer = self.connection.add_timeout(self.ack_delay, self._on_ack_timer)
+
+    def _on_ack_timer(self):
+        self._ack_timer = None
+        self._flush_acks()
+
+    def _flush_acks(self):
+        '''
+        Ack with a single frame all processed messages delivered before the oldest running one
+        '''
+        if self._ack_timer is not None:
+            self.connection.remove_timeout(self._ack_timer)
+            self._ack_timer = None
+        if not self._processed_tags:
+            return
+        if self._running_tags:
+            # multiple ack would also ack running messages with a lower tag
+            oldest_running_tag = min(self._running_tags)
+            ack_tags = [tag for tag in self._processed_tags if tag < oldest_running_tag]
+        else:
+            ack_tags = list(self._processed_tags)
+        if not ack_tags:
+            return
+        self.channel.basic_ack(delivery_tag=max(ack_tags), multiple=True)
+        self._processed_tags.difference_update(ack_tags)
+
+    def callback_messages(self, ch, method, properties, body):
+        '''
+        Manage download and send ACK message
+
+        Operations are run in the worker pool, ACK is sent once the operation is over.
+        '''
+        delivery_tag = method.delivery_tag
+        if self.executor is None or self.connection is None:
+            self._process_message(body)
+            ch.basic_ack(delivery_tag=delivery_tag)
+            return
+        self._running_tags.add(delivery_tag)
+        future = self.executor.submit(self._process_message, body)
+        future.add_done_callback(lambda f: self._ack_message(ch, delivery_tag))
+
+    def _ensure_topology(self):
+        '''
+        Declare the download queue, once per service
+
+        Publishers (ask_download) expect the queue to exist and never declare it
+        '''
+        if self.topology_declared:
+            return
+        # Queue arguments are opt-in, declaring an existing queue with
+        # different arguments is refused by rabbitmq
+        queue_arguments = {}
+        if self.config['rabbitmq'].get('queue_mode'):
+            queue_arguments['x-queue-mode'] = self.config['rabbitmq']['queue_mode']
+        if self.config['rabbitmq'].get('max_length'):
+            queue_arguments['x-max-length'] = self.config['rabbitmq']['max_length']
+        self.channel.queue_declare(queue='biomajdownload', durable=True, arguments=queue_arguments or None)
+        self.topology_declared = True
 
     def wait_for_messages(self):
         '''
         Loop queue waiting for messages
+
+        Up to rabbitmq.consumer_threads messages are processed in parallel,
+        prefetch count (rabbitmq.prefetch_count) defaults to the number of threads.
         '''
-        self.channel.queue_declare(queue='biomajdownload', durable=True)
-        self.channel.basic_qos(prefetch_count=1)
+        if api_implementation.Type() == 'python':
+            self.logger.warn('Using pure python protobuf implementation, message parsing will be slow')
+        else:
+            self.logger.debug('Using protobuf %s implementation' % (api_implementation.Type()))
+        consumer_threads = self.config['rabbitmq'].get('consumer_threads', 1)
+        self.executor = ThreadPoolExecutor(max_workers=consumer_threads)
+        self.ack_batch_size = self.config['rabbitmq'].get('ack_batch_size', 1)
+        self.ack_delay = self.config['rabbitmq'].get('ack_delay', 1)
+        self._running_tags = set()
+        self._processed_tags = set()
+        self._ack_timer = None
+        self._ensure_topology()
+        prefetch_count = self.config['rabbitmq'].get('prefetch_count', consumer_threads)
+        # per consumer limit
+        self.channel.basic_qos(prefetch_count=prefetch_count, all_channels=False)
         self.channel.basic_consume(
             self.callback_messages,
             queue='biomajdownload')
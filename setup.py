@@ -8,14 +8,21 @@ import os
 
 
 here = os.path.abspath(os.path.dirname(__file__))
-with open(os.path.join(here, 'README.md')) as f:
-    README = f.read()
-with open(os.path.join(here, 'CHANGES.txt')) as f:
-    CHANGES = f.read()
 
 
-with open('requirements.txt') as f:
-    requirements = f.read().splitlines()
+def read(name):
+    with open(os.path.join(here, name), encoding='utf-8') as f:
+        return f.read()
+
+
+README = read('README.md')
+CHANGES = read('CHANGES.txt')
+
+
+requirements = [
+    line for line in read('requirements.txt').splitlines()
+    if line.strip() and not line.startswith('#')
+]
 
 
 config = {
@@ -26,7 +33,7 @@ config = {
     'url': 'http://biomaj.genouest.org',
     'download_url': 'http://biomaj.genouest.org',
     'author_email': 'olivier.sallou@irisa.fr',
-    'version': '3.2.11',
+    'version': '3.2.12',
     'classifiers': [
         # How mature is this project? Common values are
         #   3 - Alpha
@@ -48,7 +55,7 @@ config = {
     ],
     'python_requires': '>=3.6, <4',
     'install_requires': requirements,
-    'tests_require': ['pytest'],
+    'tests_require': ['pytest', 'fakeredis[lua]'],
     'packages': find_packages(),
     'include_package_data': True,
     'scripts': ['bin/biomaj_download_consumer.py'],
@@ -1,22 +1,37 @@
 """
-Note that attributes 'network' and 'local_irods' are ignored for CI.
+Note that markers 'network' and 'local_irods' are ignored for CI.
 
 To run 'local_irods' tests, you need an iRODS server on localhost (default port,
 user 'rods', password 'rods') and a zone /tempZone/home/rods. See
 UtilsForLocalIRODSTest.
+
+Test files are created in the directory set in BIOMAJ_TEST_TMPDIR (for
+instance /dev/shm), or else in the default temporary directory.
 """
 
+import base64
+import concurrent.futures
+import functools
 import json
+import re
 import shutil
 import os
+import pathlib
 import tempfile
 import logging
 import stat
+import threading
+import time
 import pytest
 
-from unittest.mock import patch
+from unittest.mock import MagicMock, call, patch
 
+import fakeredis
+import pika
+from flask import Flask, jsonify, request
 from irods.session import iRODSSession
+from werkzeug.serving import make_server
+from irods.models import Collection, DataObject
 
 from biomaj_core.config import BiomajConfig
 from biomaj_core.utils import Utils
@@ -26,11 +41,63 @@ from biomaj_download.download.direct import DirectFTPDownload, DirectHTTPDownloa
 from biomaj_download.download.localcopy  import LocalDownload
 from biomaj_download.download.rsync import RSYNCDownload
 from biomaj_download.download.protocolirods import IRODSDownload
+from biomaj_download.downloadclient import DownloadClient
+from biomaj_download.downloadservice import DownloadService, MAX_SESSION_ERRORS, SESSION_KEY_SUFFIXES
+from biomaj_download.message import downmessage_pb2
 
 import unittest
 import tenacity
 
 
+TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
+BANK_DIR = os.path.join(TESTS_DIR, 'bank')
+# Sample configuration of the download service (TestDownloadService)
+SERVICE_CONFIG = os.path.join(os.path.dirname(TESTS_DIR), 'config.yml')
+
+# Banks using external resources, their properties are used as is
+BANK_PROPERTIES = ('alu', 'testhttp', 'directhttp', 'multi')
+# Banks using BANK_DIR as remote directory
+LOCAL_BANK_PROPERTIES = ('local', 'localprocess', 'computed', 'computed2', 'sub1', 'sub2', 'computederror', 'error')
+PROPERTIES_TEMPLATES = {
+  name: os.path.join(TESTS_DIR, name + '.properties')
+  for name in BANK_PROPERTIES + LOCAL_BANK_PROPERTIES + ('global',)
+}
+
+# Properties rewritten to use the test directories
+GLOBAL_DIRS_RE = re.compile(r'^(conf\.dir|log\.dir|data\.dir|process\.dir|lock\.dir)=.*$', re.M)
+REMOTE_DIR_RE = re.compile(r'^remote\.dir.*$', re.M)
+REMOTE_FILES_RE = re.compile(r'^remote\.files.*$', re.M)
+
+# Listing format of mirrors.edge.kernel.org (TestBiomajHTTPSDownload)
+HTTPS_DIR_LINE = r'<a[\s]+href="([\w\-\.]+">[\w\-\.]+.tar.gz)<\/a>[\s]+([0-9]{2}-[A-Za-z]{3}-[0-9]{4}[\s][0-9]{2}:[0-9]{2})[\s]+([0-9]+[A-Za-z])'
+HTTPS_FILE_LINE = r'<a[\s]+href="[\w\-\.]+">([\w\-\.]+.tar.gz)<\/a>[\s]+([0-9]{2}-[A-Za-z]{3}-[0-9]{4}[\s][0-9]{2}:[0-9]{2})[\s]+([0-9]+[A-Za-z])'
+
+
+def link_or_copy(from_file, to_file):
+  """
+  Hard link a read-only test file, or copy it when the temp directory is
+  on another filesystem
+  """
+  try:
+    os.link(from_file, to_file)
+  except OSError:
+    shutil.copyfile(from_file, to_file)
+
+
+@functools.lru_cache(maxsize=None)
+def read_properties(name):
+  """
+  Content of a properties template, banks of LOCAL_BANK_PROPERTIES being
+  adapted to use BANK_DIR as remote. Read once per test run.
+  """
+  with open(PROPERTIES_TEMPLATES[name],'r') as fin:
+    content = fin.read()
+  if name in LOCAL_BANK_PROPERTIES:
+    content = REMOTE_DIR_RE.sub(lambda m: "remote.dir=" + BANK_DIR, content)
+    content = REMOTE_FILES_RE.sub(lambda m: m.group(0).replace('/tmp', BANK_DIR), content)
+  return content
+
+
 class UtilsForTest():
   """
   Copy properties files to a temp directory and update properties to
@@ -44,26 +111,15 @@ class UtilsForTest():
     self.global_properties = None
     self.bank_properties = None
 
-    self.test_dir = tempfile.mkdtemp('biomaj')
-
-    self.conf_dir =os.path.join(self.test_dir,'conf')
-    if not os.path.exists(self.conf_dir):
-      os.makedirs(self.conf_dir)
-    self.data_dir =os.path.join(self.test_dir,'data')
-    if not os.path.exists(self.data_dir):
-      os.makedirs(self.data_dir)
-    self.log_dir =os.path.join(self.test_dir,'log')
-    if not os.path.exists(self.log_dir):
-      os.makedirs(self.log_dir)
-    self.process_dir =os.path.join(self.test_dir,'process')
-    if not os.path.exists(self.process_dir):
-      os.makedirs(self.process_dir)
-    self.lock_dir =os.path.join(self.test_dir,'lock')
-    if not os.path.exists(self.lock_dir):
-      os.makedirs(self.lock_dir)
-    self.cache_dir =os.path.join(self.test_dir,'cache')
-    if not os.path.exists(self.cache_dir):
-      os.makedirs(self.cache_dir)
+    # Removed by clean(), or when garbage collected if a test class setup fails
+    self._tmp_dir = tempfile.TemporaryDirectory('biomaj', dir=os.environ.get('BIOMAJ_TEST_TMPDIR'))
+    self.test_dir = self._tmp_dir.name
+
+    # Sets self.conf_dir, self.data_dir, etc.
+    for name in ('conf', 'data', 'log', 'process', 'lock', 'cache'):
+      dir_path = os.path.join(self.test_dir, name)
+      os.makedirs(dir_path, exist_ok=True)
+      setattr(self, name + '_dir', dir_path)
 
 
     if self.global_properties is None:
@@ -75,74 +131,63 @@ class UtilsForTest():
     # Create an invalid archive file (empty file). This is deleted by clean().
     # See TestBiomajRSYNCDownload.test_rsync_download_skip_check_uncompress.
     self.invalid_archive = os.path.join(self.test_dir, 'invalid.gz')
-    open(self.invalid_archive, 'w').close()
+    pathlib.Path(self.invalid_archive).touch()
 
   def clean(self):
     """
     Deletes temp directory
     """
-    shutil.rmtree(self.test_dir)
+    self._tmp_dir.cleanup()
+
+  def clean_data(self):
+    """
+    Empty the data directory, used between the tests of a class sharing
+    the same UtilsForTest
+    """
+    shutil.rmtree(self.data_dir)
+    os.makedirs(self.data_dir)
 
   def __copy_test_bank_properties(self):
     if self.bank_properties is not None:
       return
     # Copy bank configuration (those bank use external resources so there is no tuning to do)
-    self.bank_properties = ['alu', 'testhttp', 'directhttp', 'multi']
-    curdir = os.path.dirname(os.path.realpath(__file__))
+    self.bank_properties = list(BANK_PROPERTIES)
     for b in self.bank_properties:
-        from_file = os.path.join(curdir, b+'.properties')
+        from_file = PROPERTIES_TEMPLATES[b]
         to_file = os.path.join(self.conf_dir, b+'.properties')
-        shutil.copyfile(from_file, to_file)
+        link_or_copy(from_file, to_file)
 
     # Copy bank process
     self.bank_process = ['test.sh']
-    curdir = os.path.dirname(os.path.realpath(__file__))
-    procdir = os.path.join(curdir, 'bank/process')
+    procdir = os.path.join(BANK_DIR, 'process')
     for proc in self.bank_process:
       from_file = os.path.join(procdir, proc)
       to_file = os.path.join(self.process_dir, proc)
+      # Copied, not linked: the mode change must not apply to the source
       shutil.copyfile(from_file, to_file)
       os.chmod(to_file, stat.S_IRWXU)
 
     # Copy and adapt bank configuration that use local resources: we use the "bank" dir in current test directory as remote
-    properties = ['local', 'localprocess', 'computed', 'computed2', 'sub1', 'sub2', 'computederror', 'error']
-    for prop in properties:
-      from_file = os.path.join(curdir, prop+'.properties')
+    for prop in LOCAL_BANK_PROPERTIES:
       to_file = os.path.join(self.conf_dir, prop+'.properties')
-      fout = open(to_file,'w')
-      with open(from_file,'r') as fin:
-        for line in fin:
-          if line.startswith('remote.dir'):
-            fout.write("remote.dir="+os.path.join(curdir,'bank')+"\n")
-          elif line.startswith('remote.files'):
-            fout.write(line.replace('/tmp', os.path.join(curdir,'bank')))
-          else:
-            fout.write(line)
-      fout.close()
+      with open(to_file,'w') as fout:
+        fout.write(read_properties(prop))
 
   def __copy_global_properties(self):
     if self.global_properties is not None:
       return
     self.global_properties = os.path.join(self.conf_dir,'global.properties')
-    curdir = os.path.dirname(os.path.realpath(__file__))
-    global_template = os.path.join(curdir,'global.properties')
-    fout = open(self.global_properties,'w')
     # Adapt directories in global configuration to the current test directory
-    with open(global_template,'r') as fin:
-        for line in fin:
-          if line.startswith('conf.dir'):
-            fout.write("conf.dir="+self.conf_dir+"\n")
-          elif line.startswith('log.dir'):
-            fout.write("log.dir="+self.log_dir+"\n")
-          elif line.startswith('data.dir'):
-            fout.write("data.dir="+self.data_dir+"\n")
-          elif line.startswith('process.dir'):
-            fout.write("process.dir="+self.process_dir+"\n")
-          elif line.startswith('lock.dir'):
-            fout.write("lock.dir="+self.lock_dir+"\n")
-          else:
-            fout.write(line)
-    fout.close()
+    dirs = {
+      'conf.dir': self.conf_dir,
+      'log.dir': self.log_dir,
+      'data.dir': self.data_dir,
+      'process.dir': self.process_dir,
+      'lock.dir': self.lock_dir
+    }
+    content = GLOBAL_DIRS_RE.sub(lambda m: m.group(1) + "=" + dirs[m.group(1)], read_properties('global'))
+    with open(self.global_properties,'w') as fout:
+      fout.write(content)
 
 
 class UtilsForLocalIRODSTest(UtilsForTest):
@@ -161,9 +206,8 @@ class UtilsForLocalIRODSTest(UtilsForTest):
         self._session = iRODSSession(host=self.SERVER, port=self.PORT,
                                      user=self.USER, password=self.PASSWORD,
                                      zone=self.ZONE)
-        self.curdir = os.path.dirname(os.path.realpath(__file__))
         # Copy some valid archives (bank/test.fasta.gz)
-        file_ = os.path.join(self.curdir, "bank/test.fasta.gz")
+        file_ = os.path.join(BANK_DIR, "test.fasta.gz")
         self._session.data_objects.put(file_, self.COLLECTION)
         # Copy invalid.gz
         self._session.data_objects.put(self.invalid_archive, self.COLLECTION)
@@ -175,6 +219,175 @@ class UtilsForLocalIRODSTest(UtilsForTest):
         self._session.data_objects.unlink(os.path.join(self.COLLECTION, "test.fasta.gz"), force=True)
         # Remove invalid.gz
         self._session.data_objects.unlink(os.path.join(self.COLLECTION, "invalid.gz"), force=True)
+        self._session.cleanup()
+
+
+def check_download_retry(downloader, data_dir, n_attempts=5):
+  """
+  Download fake files with a downloader, checking that each download is
+  attempted n_attempts times (retries without waiting).
+  """
+  downloader.set_options(dict(downloader.options,
+                              stop_condition=tenacity.stop.stop_after_attempt(n_attempts),
+                              wait_policy=tenacity.wait.wait_none()))
+  # Download a second file to ensure that it retries again
+  for name in ('TOTO.zip', 'TITI.zip'):
+    downloader.set_files_to_download([
+          {'name': name, 'year': '2016', 'month': '02', 'day': '19',
+           'size': 1, 'save_as': 'TOTO1KB'}
+    ])
+    with pytest.raises(Exception):
+      downloader.download(data_dir)
+    logging.debug(downloader.retryer.statistics)
+    assert (len(downloader.files_to_download) == 1)
+    assert (downloader.retryer.statistics["attempt_number"] == n_attempts)
+
+
+class LocalHTTPBin():
+  """
+  Local HTTP server replacing the httpbin.org endpoints used in tests:
+  /get and /post return their query or form parameters as JSON.
+  """
+
+  def __init__(self):
+    app = Flask(__name__)
+
+    @app.route('/get')
+    def get():
+      return jsonify(args=request.args.to_dict())
+
+    @app.route('/post', methods=['POST'])
+    def post():
+      return jsonify(form=request.form.to_dict())
+
+    self._server = make_server('127.0.0.1', 0, app, threaded=True)
+    self.host = '127.0.0.1:%d' % self._server.server_port
+    self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    self._server.shutdown()
+    self._thread.join()
+
+
+class FakeConnection():
+  """
+  Replaces pika.BlockingConnection for DownloadService tests: callbacks
+  added from worker threads are run by process_data_events(), as they
+  would be in the connection thread.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.callbacks = []
+    self.timeouts = {}
+
+  def add_callback_threadsafe(self, callback):
+    with self._lock:
+      self.callbacks.append(callback)
+
+  def process_data_events(self, time_limit=0):
+    with self._lock:
+      (callbacks, self.callbacks) = (self.callbacks, [])
+    for callback in callbacks:
+      callback()
+
+  def add_timeout(self, deadline, callback):
+    timeout_id = object()
+    self.timeouts[timeout_id] = callback
+    return timeout_id
+
+  def remove_timeout(self, timeout_id):
+    del self.timeouts[timeout_id]
+
+  def run_timeouts(self):
+    """
+    Expire all pending timeouts
+    """
+    (timeouts, self.timeouts) = (self.timeouts, {})
+    for callback in timeouts.values():
+      callback()
+
+
+class ManualExecutor():
+  """
+  Replaces the worker pool of DownloadService in tests: submitted tasks are
+  not run, the test completes them in the order of its choice.
+  """
+
+  def __init__(self, max_workers=None):
+    self.futures = []
+
+  def submit(self, fn, *args):
+    future = concurrent.futures.Future()
+    self.futures.append(future)
+    return future
+
+  def complete(self, *numbers):
+    """
+    Complete tasks by submission number, starting at 1 like delivery tags
+    """
+    for number in numbers:
+      self.futures[number - 1].set_result(None)
+
+  def shutdown(self, wait=True):
+    for future in self.futures:
+      if not future.done():
+        future.set_result(None)
+
+
+def download_service(redis_server):
+  """
+  DownloadService using the sample configuration, redis_server (a
+  fakeredis.FakeServer) and a mocked rabbitmq channel
+  """
+  with patch('redis.StrictRedis', functools.partial(fakeredis.FakeStrictRedis, server=redis_server)):
+    service = DownloadService(SERVICE_CONFIG, rabbitmq=False)
+  service.connection = FakeConnection()
+  service.channel = MagicMock()
+  return service
+
+
+def remote_download_client():
+  """
+  DownloadClient sending downloads to remote services, with a mocked
+  rabbitmq connection
+  """
+  with patch('pika.BlockingConnection'):
+    client = DownloadClient(rabbitmq_host='localhost')
+  client.proxy = 'http://localhost'
+  client.bank = 'bank'
+  client.session = 'session'
+  return client
+
+
+def download_operation(bank, session, local_dir, name='test.fasta.gz'):
+  """
+  Operation downloading name from BANK_DIR with the local protocol
+  """
+  operation = downmessage_pb2.Operation()
+  operation.type = 1
+  message = operation.download
+  message.bank = bank
+  message.session = session
+  message.local_dir = local_dir
+  message.remote_file.protocol = downmessage_pb2.DownloadFile.LOCAL
+  message.remote_file.server = 'localhost'
+  message.remote_file.remote_dir = BANK_DIR + '/'
+  remote_file = message.remote_file.files.add()
+  remote_file.name = name
+  remote_file.save_as = name
+  return operation
+
+
+def deliver(service, delivery_tag, operation):
+  """
+  Deliver an operation to service as rabbitmq would
+  """
+  service.callback_messages(service.channel,
+                            pika.spec.Basic.Deliver(delivery_tag=delivery_tag),
+                            None,
+                            operation.SerializeToString())
 
 
 class TestDownloadInterface():
@@ -182,43 +395,39 @@ class TestDownloadInterface():
   Test of the interface.
   """
 
-  def test_retry_parsing(self):
+  @pytest.mark.parametrize("options", [
+    # Test some garbage
+    dict(stop_condition="stop_after_attempts"),  # no param
+    dict(stop_condition="stop_after_attempts(5) & 1"),  # not a stop_condition
+    dict(wait_policy="wait_random"),  # no param
+    dict(wait_policy="I love python"),  # not a wait_condition
+    #dict(wait_policy="wait_random(5) + 3"),  # not a wait_condition
+  ])
+  def test_retry_parsing_error(self, options):
     """
-    Test parsing of stop and wait conditions.
+    Test that invalid stop and wait conditions are rejected.
     """
     downloader = DownloadInterface()
-    # Test some garbage
-    d = dict(stop_condition="stop_after_attempts")  # no param
-    with pytest.raises(ValueError):
-      downloader.set_options(d)
-    d = dict(stop_condition="stop_after_attempts(5) & 1")  # not a stop_condition
-    with pytest.raises(ValueError):
-      downloader.set_options(d)
-    # Test some garbage
-    d = dict(wait_policy="wait_random")  # no param
-    with pytest.raises(ValueError):
-      downloader.set_options(d)
-    d = dict(wait_policy="I love python")  # not a wait_condition
     with pytest.raises(ValueError):
-      downloader.set_options(d)
-    #d = dict(wait_policy="wait_random(5) + 3")  # not a wait_condition
-    #self.assertRaises(ValueError, downloader.set_options, d)
+      downloader.set_options(options)
+
+  @pytest.mark.parametrize("options", [
     # Test operators
-    d = dict(stop_condition="stop_never | stop_after_attempt(5)",
-             wait_policy="wait_none + wait_random(1, 2)")
-    downloader.set_options(d)
+    dict(stop_condition="stop_never | stop_after_attempt(5)",
+         wait_policy="wait_none + wait_random(1, 2)"),
     # Test wait_combine, wait_chain
-    d = dict(wait_policy="wait_combine(wait_fixed(3), wait_random(1, 2))")
-    downloader.set_options(d)
-    d = dict(wait_policy="wait_chain(wait_fixed(3), wait_random(1, 2))")
-    downloader.set_options(d)
+    dict(wait_policy="wait_combine(wait_fixed(3), wait_random(1, 2))"),
+    dict(wait_policy="wait_chain(wait_fixed(3), wait_random(1, 2))"),
     # Test stop_any and stop_all
-    stop_condition = "stop_any(stop_after_attempt(5), stop_after_delay(10))"
-    d = dict(stop_condition=stop_condition)
-    downloader.set_options(d)
-    stop_condition = "stop_all(stop_after_attempt(5), stop_after_delay(10))"
-    d = dict(stop_condition=stop_condition)
-    downloader.set_options(d)
+    dict(stop_condition="stop_any(stop_after_attempt(5), stop_after_delay(10))"),
+    dict(stop_condition="stop_all(stop_after_attempt(5), stop_after_delay(10))"),
+  ])
+  def test_retry_parsing(self, options):
+    """
+    Test parsing of stop and wait conditions.
+    """
+    downloader = DownloadInterface()
+    downloader.set_options(options)
 
 
 class TestBiomajLocalDownload():
@@ -226,23 +435,31 @@ class TestBiomajLocalDownload():
   Test Local downloader
   """
 
-  def setup_method(self, m):
-    self.utils = UtilsForTest()
-
-    self.curdir = os.path.dirname(os.path.realpath(__file__))
-    self.examples = os.path.join(self.curdir,'bank') + '/'
+  curdir = TESTS_DIR
+  examples = BANK_DIR + '/'
 
-    BiomajConfig.load_config(self.utils.global_properties, allow_user_config=False)
+  @classmethod
+  def setup_class(cls):
+    cls.utils = UtilsForTest()
+    BiomajConfig.load_config(cls.utils.global_properties, allow_user_config=False)
 
+  @classmethod
+  def teardown_class(cls):
+    cls.utils.clean()
 
   def teardown_method(self, m):
-    self.utils.clean()
+    self.utils.clean_data()
 
   def test_local_list(self):
     locald = LocalDownload(self.examples)
     (file_list, dir_list) = locald.list()
     locald.close()
-    assert (len(file_list) > 1)
+    with os.scandir(self.examples) as it:
+      entries = list(it)
+    assert ({f['name'] for f in file_list} ==
+            {e.name for e in entries if not e.is_dir()})
+    assert ({d['name'] for d in dir_list} ==
+            {e.name for e in entries if e.is_dir()})
 
   def test_local_list_error(self):
     locald = LocalDownload("/tmp/foo/")
@@ -293,6 +510,7 @@ class TestBiomajLocalDownload():
       logging.info(msg)
 
 
+@pytest.mark.network
 @pytest.mark.skipif(
   os.environ.get('NETWORK', 1) == '0',
   reason='network tests disabled'
@@ -301,24 +519,33 @@ class TestBiomajHTTPDownload():
   """
   Test HTTP downloader
   """
-  def setup_method(self, m):
-    self.utils = UtilsForTest()
-    BiomajConfig.load_config(self.utils.global_properties, allow_user_config=False)
-    # Create an HTTPParse object used for most tests from the config file testhttp
-    self.config = BiomajConfig('testhttp')
-    self.http_parse = HTTPParse(
-        self.config.get('http.parse.dir.line'),
-        self.config.get('http.parse.file.line'),
-        int(self.config.get('http.group.dir.name')),
-        int(self.config.get('http.group.dir.date')),
-        int(self.config.get('http.group.file.name')),
-        int(self.config.get('http.group.file.date')),
-        self.config.get('http.group.file.date_format'),
-        int(self.config.get('http.group.file.size'))
+  @classmethod
+  def setup_class(cls):
+    cls.utils = UtilsForTest()
+    BiomajConfig.load_config(cls.utils.global_properties, allow_user_config=False)
+    # HTTPParse arguments read once from the config file testhttp
+    config = BiomajConfig('testhttp')
+    cls.http_parse_args = (
+        config.get('http.parse.dir.line'),
+        config.get('http.parse.file.line'),
+        int(config.get('http.group.dir.name')),
+        int(config.get('http.group.dir.date')),
+        int(config.get('http.group.file.name')),
+        int(config.get('http.group.file.date')),
+        config.get('http.group.file.date_format'),
+        int(config.get('http.group.file.size'))
     )
 
+  @classmethod
+  def teardown_class(cls):
+    cls.utils.clean()
+
+  def setup_method(self, m):
+    # Create an HTTPParse object used for most tests
+    self.http_parse = HTTPParse(*self.http_parse_args)
+
   def teardown_method(self, m):
-    self.utils.clean()
+    self.utils.clean_data()
 
   def test_http_list(self):
     httpd = CurlDownload('http', 'ftp2.fr.debian.org', '/debian/dists/', self.http_parse)
@@ -345,15 +572,7 @@ class TestBiomajHTTPDownload():
 
   def test_http_download_no_size(self):
     # Create a custom http_parse without size
-    http_parse = HTTPParse(self.config.get('http.parse.dir.line'),
-        self.config.get('http.parse.file.line'),
-        int(self.config.get('http.group.dir.name')),
-        int(self.config.get('http.group.dir.date')),
-        int(self.config.get('http.group.file.name')),
-        int(self.config.get('http.group.file.date')),
-        self.config.get('http.group.file.date_format'),
-        -1
-    )
+    http_parse = HTTPParse(*self.http_parse_args[:7], -1)
     httpd = CurlDownload('http', 'ftp2.fr.debian.org', '/debian/dists/', http_parse)
     (file_list, dir_list) = httpd.list()
     httpd.match([r'^README$'], file_list, dir_list)
@@ -363,15 +582,7 @@ class TestBiomajHTTPDownload():
 
   def test_http_download_no_date(self):
     # Create a custom http_parse without date
-    http_parse = HTTPParse(self.config.get('http.parse.dir.line'),
-        self.config.get('http.parse.file.line'),
-        int(self.config.get('http.group.dir.name')),
-        int(self.config.get('http.group.dir.date')),
-        int(self.config.get('http.group.file.name')),
-        -1,
-        None,
-        int(self.config.get('http.group.file.size'))
-    )
+    http_parse = HTTPParse(*self.http_parse_args[:5], -1, None, self.http_parse_args[7])
     httpd = CurlDownload('http', 'ftp2.fr.debian.org', '/debian/dists/', http_parse)
     (file_list, dir_list) = httpd.list()
     httpd.match([r'^README$'], file_list, dir_list)
@@ -379,19 +590,15 @@ class TestBiomajHTTPDownload():
     httpd.close()
     assert (len(httpd.files_to_download) == 1)
 
-  def test_http_download(self):
-    httpd = CurlDownload('http', 'ftp2.fr.debian.org', '/debian/dists/', self.http_parse)
+  @pytest.mark.parametrize("remote_dir, pattern", [
+    ('/debian/dists/', r'^README$'),
+    # Match in a subdirectory
+    ('/debian/', r'^dists/README$'),
+  ])
+  def test_http_download(self, remote_dir, pattern):
+    httpd = CurlDownload('http', 'ftp2.fr.debian.org', remote_dir, self.http_parse)
     (file_list, dir_list) = httpd.list()
-    print(str(file_list))
-    httpd.match([r'^README$'], file_list, dir_list)
-    httpd.download(self.utils.data_dir)
-    httpd.close()
-    assert (len(httpd.files_to_download) == 1)
-
-  def test_http_download_in_subdir(self):
-    httpd = CurlDownload('http', 'ftp2.fr.debian.org', '/debian/', self.http_parse)
-    (file_list, dir_list) = httpd.list()
-    httpd.match([r'^dists/README$'], file_list, dir_list)
+    httpd.match([pattern], file_list, dir_list)
     httpd.download(self.utils.data_dir)
     httpd.close()
     assert (len(httpd.files_to_download) == 1)
@@ -433,6 +640,7 @@ class TestBiomajHTTPDownload():
     httpd.close()
 
 
+@pytest.mark.network
 @pytest.mark.skipif(
   os.environ.get('NETWORK', 1) == '0',
   reason='network tests disabled'
@@ -442,16 +650,21 @@ class TestBiomajHTTPSDownload():
   Test HTTPS downloader
   """
 
-  def setup_method(self, m):
-    self.utils = UtilsForTest()
+  @classmethod
+  def setup_class(cls):
+    cls.utils = UtilsForTest()
+
+  @classmethod
+  def teardown_class(cls):
+    cls.utils.clean()
 
   def teardown_method(self, m):
-    self.utils.clean()
+    self.utils.clean_data()
 
   def test_download(self):
     http_parse = HTTPParse(
-        "<a[\s]+href=\"([\w\-\.]+\">[\w\-\.]+.tar.gz)<\/a>[\s]+([0-9]{2}-[A-Za-z]{3}-[0-9]{4}[\s][0-9]{2}:[0-9]{2})[\s]+([0-9]+[A-Za-z])",
-        "<a[\s]+href=\"[\w\-\.]+\">([\w\-\.]+.tar.gz)<\/a>[\s]+([0-9]{2}-[A-Za-z]{3}-[0-9]{4}[\s][0-9]{2}:[0-9]{2})[\s]+([0-9]+[A-Za-z])",
+        HTTPS_DIR_LINE,
+        HTTPS_FILE_LINE,
         1,
         2,
         1,
@@ -467,6 +680,7 @@ class TestBiomajHTTPSDownload():
     assert (len(httpd.files_to_download) == 1)
 
 
+@pytest.mark.network
 @pytest.mark.skipif(
   os.environ.get('NETWORK', 1) == '0',
   reason='network tests disabled'
@@ -478,13 +692,20 @@ class TestBiomajSFTPDownload():
 
   PROTOCOL = "sftp"
 
+  @classmethod
+  def setup_class(cls):
+    cls.utils = UtilsForTest()
+
+  @classmethod
+  def teardown_class(cls):
+    cls.utils.clean()
+
   def setup_method(self, m):
-    self.utils = UtilsForTest()
     # Temporary host key file in test dir (so this is cleaned)
     (_, self.khfile) = tempfile.mkstemp(dir=self.utils.test_dir)
 
   def teardown_method(self, m):
-    self.utils.clean()
+    self.utils.clean_data()
 
   def test_list_error(self):
     """
@@ -519,6 +740,7 @@ class TestBiomajSFTPDownload():
     assert (len(sftpd.files_to_download) == 1)
 
 
+@pytest.mark.network
 @pytest.mark.skipif(
   os.environ.get('NETWORK', 1) == '0',
   reason='network tests disabled'
@@ -528,11 +750,16 @@ class TestBiomajDirectFTPDownload():
   Test DirectFTP downloader
   """
 
-  def setup_method(self):
-    self.utils = UtilsForTest()
+  @classmethod
+  def setup_class(cls):
+    cls.utils = UtilsForTest()
+
+  @classmethod
+  def teardown_class(cls):
+    cls.utils.clean()
 
   def teardown_method(self, m):
-    self.utils.clean()
+    self.utils.clean_data()
 
   def test_ftp_list(self):
     file_list = ['/debian/doc/mailing-lists.txt']
@@ -565,6 +792,7 @@ class TestBiomajDirectFTPDownload():
     assert (os.path.exists(os.path.join(self.utils.data_dir,'mailing-lists.txt')))
 
 
+@pytest.mark.network
 @pytest.mark.skipif(
   os.environ.get('NETWORK', 1) == '0',
   reason='network tests disabled'
@@ -574,11 +802,16 @@ class TestBiomajDirectFTPSDownload():
   Test DirectFTP downloader with FTPS.
   """
 
-  def setup_method(self, m):
-    self.utils = UtilsForTest()
+  @classmethod
+  def setup_class(cls):
+    cls.utils = UtilsForTest()
+
+  @classmethod
+  def teardown_class(cls):
+    cls.utils.clean()
 
   def teardown_method(self, m):
-    self.utils.clean()
+    self.utils.clean_data()
 
   def test_ftps_list(self):
     file_list = ['/readme.txt']
@@ -600,6 +833,7 @@ class TestBiomajDirectFTPSDownload():
     assert (os.path.exists(os.path.join(self.utils.data_dir,'readme.txt')))
 
 
+@pytest.mark.network
 @pytest.mark.skipif(
   os.environ.get('NETWORK', 1) == '0',
   reason='network tests disabled'
@@ -609,11 +843,18 @@ class TestBiomajDirectHTTPDownload():
   Test DirectFTP downloader
   """
 
-  def setup_method(self, m):
-    self.utils = UtilsForTest()
+  @classmethod
+  def setup_class(cls):
+    cls.utils = UtilsForTest()
+    cls.httpbin = LocalHTTPBin()
+
+  @classmethod
+  def teardown_class(cls):
+    cls.httpbin.stop()
+    cls.utils.clean()
 
   def teardown_method(self, m):
-    self.utils.clean()
+    self.utils.clean_data()
 
   def test_http_list(self):
     file_list = ['/debian/README.html']
@@ -652,7 +893,7 @@ class TestBiomajDirectHTTPDownload():
 
   def test_download_get_params_save_as(self):
     file_list = ['/get']
-    ftpd = DirectHTTPDownload('http', 'httpbin.org', '')
+    ftpd = DirectHTTPDownload('http', self.httpbin.host, '')
     ftpd.set_files_to_download(file_list)
     ftpd.param = { 'key1': 'value1', 'key2': 'value2'}
     ftpd.save_as = 'test.json'
@@ -678,7 +919,7 @@ class TestBiomajDirectHTTPDownload():
   def test_download_post_params(self):
     #file_list = ['/debian/README.html']
     file_list = ['/post']
-    ftpd = DirectHTTPDownload('http', 'httpbin.org', '')
+    ftpd = DirectHTTPDownload('http', self.httpbin.host, '')
     ftpd.set_files_to_download(file_list)
     ftpd.param = { 'key1': 'value1', 'key2': 'value2'}
     ftpd.save_as = 'test.json'
@@ -716,6 +957,7 @@ class TestBiomajDirectHTTPDownload():
     httpd.close()
 
 
+@pytest.mark.network
 @pytest.mark.skipif(
   os.environ.get('NETWORK', 1) == '0',
   reason='network tests disabled'
@@ -729,11 +971,16 @@ class TestBiomajFTPDownload():
   Test FTP downloader
   """
 
-  def setup_method(self, m):
-    self.utils = UtilsForTest()
+  @classmethod
+  def setup_class(cls):
+    cls.utils = UtilsForTest()
+
+  @classmethod
+  def teardown_class(cls):
+    cls.utils.clean()
 
   def teardown_method(self, m):
-    self.utils.clean()
+    self.utils.clean_data()
 
   def test_ftp_list(self):
     ftpd = CurlDownload('ftp', 'speedtest.tele2.net', '/')
@@ -848,29 +1095,8 @@ class TestBiomajFTPDownload():
     """
     Try to download fake files to test retry.
     """
-    n_attempts = 5
     ftpd = CurlDownload("ftp", "speedtest.tele2.net", "/")
-    # Download a fake file
-    ftpd.set_files_to_download([
-          {'name': 'TOTO.zip', 'year': '2016', 'month': '02', 'day': '19',
-           'size': 1, 'save_as': 'TOTO1KB'}
-    ])
-    ftpd.set_options(dict(stop_condition=tenacity.stop.stop_after_attempt(n_attempts),
-                          wait_condition=tenacity.wait.wait_none()))
-    with pytest.raises(Exception):
-          ftpd.download(self.utils.data_dir)
-    logging.debug(ftpd.retryer.statistics)
-    assert (len(ftpd.files_to_download) == 1)
-    assert (ftpd.retryer.statistics["attempt_number"] == n_attempts)
-    # Try to download another file to ensure that it retryies
-    ftpd.set_files_to_download([
-          {'name': 'TITI.zip', 'year': '2016', 'month': '02', 'day': '19',
-           'size': 1, 'save_as': 'TOTO1KB'}
-    ])
-    with pytest.raises(Exception):
-      ftpd.download(self.utils.data_dir)
-    assert (len(ftpd.files_to_download) == 1)
-    assert (ftpd.retryer.statistics["attempt_number"] == n_attempts)
+    check_download_retry(ftpd, self.utils.data_dir)
     ftpd.close()
 
   def test_ms_server(self):
@@ -911,6 +1137,7 @@ class TestBiomajFTPDownload():
       assert (len(ftpd.files_to_download) == 1)
 
 
+@pytest.mark.network
 @pytest.mark.skipif(
   os.environ.get('NETWORK', 1) == '0',
   reason='network tests disabled'
@@ -925,11 +1152,16 @@ class TestBiomajFTPSDownload():
   """
   PROTOCOL = "ftps"
 
-  def setup_method(self, m):
-    self.utils = UtilsForTest()
+  @classmethod
+  def setup_class(cls):
+    cls.utils = UtilsForTest()
+
+  @classmethod
+  def teardown_class(cls):
+    cls.utils.clean()
 
   def teardown_method(self, m):
-    self.utils.clean()
+    self.utils.clean_data()
 
   def test_ftps_list(self):
     ftpd = CurlDownload(self.PROTOCOL, "test.rebex.net", "/")
@@ -999,8 +1231,7 @@ class TestBiomajFTPSDownload():
     DIRECTORY = "/download/"
     CREDENTIALS = "demo:demo"
     ftpd = CurlDownload(self.PROTOCOL, SERVER, DIRECTORY)
-    curdir = os.path.dirname(os.path.realpath(__file__))
-    cert_file = os.path.join(curdir, "caert.demo.wftpserver.com.pem")
+    cert_file = os.path.join(TESTS_DIR, "caert.demo.wftpserver.com.pem")
     ftpd.set_options(dict(ssl_verifyhost="False", ssl_server_cert=cert_file))
     ftpd.set_credentials(CREDENTIALS)
     (file_list, dir_list) = ftpd.list()
@@ -1018,15 +1249,20 @@ class TestBiomajRSYNCDownload():
     '''
     Test RSYNC downloader
     '''
-    def setup_method(self, m):
-        self.utils = UtilsForTest()
+    curdir = TESTS_DIR + '/'
+    examples = BANK_DIR + '/'
 
-        self.curdir = os.path.dirname(os.path.realpath(__file__)) + '/'
-        self.examples = os.path.join(self.curdir,'bank') + '/'
-        BiomajConfig.load_config(self.utils.global_properties, allow_user_config=False)
+    @classmethod
+    def setup_class(cls):
+        cls.utils = UtilsForTest()
+        BiomajConfig.load_config(cls.utils.global_properties, allow_user_config=False)
+
+    @classmethod
+    def teardown_class(cls):
+        cls.utils.clean()
 
     def teardown_method(self, m):
-        self.utils.clean()
+        self.utils.clean_data()
 
     def test_rsync_list(self):
         rsyncd = RSYNCDownload(self.examples, "")
@@ -1058,7 +1294,7 @@ class TestBiomajRSYNCDownload():
         rsyncd = RSYNCDownload(self.examples, "")
         (files_list, dir_list) = rsyncd.list()
         rsyncd.match([r'^test.*\.gz$'],files_list,dir_list, prefix='')
-        download_files=rsyncd.download(self.curdir)
+        download_files=rsyncd.download(self.utils.data_dir)
         assert (len(download_files)==1)
 
     def test_rsync_download_or_copy(self):
@@ -1091,38 +1327,23 @@ class TestBiomajRSYNCDownload():
         """
         Try to download fake files to test retry.
         """
-        n_attempts = 5
         rsyncd = RSYNCDownload(self.utils.test_dir + '/', "")
         rsyncd.set_options(dict(skip_check_uncompress=True))
-        # Download a fake file
-        rsyncd.set_files_to_download([
-              {'name': 'TOTO.zip', 'year': '2016', 'month': '02', 'day': '19',
-               'size': 1, 'save_as': 'TOTO1KB'}
-        ])
-        rsyncd.set_options(dict(stop_condition=tenacity.stop.stop_after_attempt(n_attempts),
-                                wait_condition=tenacity.wait.wait_none()))
-
-        with pytest.raises(Exception):
-          rsyncd.download(self.utils.data_dir)
-
-        logging.debug(rsyncd.retryer.statistics)
-        assert (len(rsyncd.files_to_download) == 1)
-        assert (rsyncd.retryer.statistics["attempt_number"] == n_attempts)
-        # Try to download another file to ensure that it retryies
-        rsyncd.set_files_to_download([
-              {'name': 'TITI.zip', 'year': '2016', 'month': '02', 'day': '19',
-               'size': 1, 'save_as': 'TOTO1KB'}
-        ])
-        with pytest.raises(Exception):
-          rsyncd.download(self.utils.data_dir)
-
-        assert (len(rsyncd.files_to_download) == 1)
-        assert (rsyncd.retryer.statistics["attempt_number"] == n_attempts)
+        check_download_retry(rsyncd, self.utils.data_dir)
         rsyncd.close()
 
 
 class iRodsResult(object):
 
+    # Attribute holding the value of each queried column
+    COLUMNS = {
+        Collection.name.icat_id: 'Collname',
+        DataObject.name.icat_id: 'Dataname',
+        DataObject.size.icat_id: 'Datasize',
+        DataObject.owner_name.icat_id: 'Dataowner_name',
+        DataObject.modify_time.icat_id: 'Datamodify_time',
+    }
+
     def __init__(self, collname, dataname, datasize, owner, modify):
         self.Collname = 'tests/'
         self.Dataname = 'test.fasta.gz'
@@ -1131,17 +1352,10 @@ class iRodsResult(object):
         self.Datamodify_time = '2017-04-10 00:00:00'
 
     def __getitem__(self, index):
-        from irods.models import Collection, DataObject, User
-        if index.icat_id == DataObject.modify_time.icat_id:
-            return self.Datamodify_time
-        elif "DATA_SIZE" in str(index):
-            return self.Datasize
-        elif "DATA_NAME" in str(index):
-            return 'test.fasta.gz'
-        elif "COLL_NAME" in str(index):
-            return self.Collname
-        elif "D_OWNER_NAME" in str(index):
-            return self.Dataowner_name
+        attribute = self.COLUMNS.get(index.icat_id)
+        if attribute is None:
+            return None
+        return getattr(self, attribute)
 
 
 class MockiRODSSession(object):
@@ -1149,6 +1363,9 @@ class MockiRODSSession(object):
     Simulation of python irods client
     for result in session.query(Collection.name, DataObject.name, DataObject.size, DataObject.owner_name, DataObject.modify_time).filter(User.name == self.user).get_results():
     '''
+    # Rows returned by every query, read only
+    RESULTS = (iRodsResult('tests/', 'test.fasta.gz', 45, 'biomaj', '2017-04-10 00:00:00'),)
+
     def __init__(self):
        self.Collname="1"
        self.Dataname="2"
@@ -1158,12 +1375,9 @@ class MockiRODSSession(object):
        self.Collid=""
 
     def __getitem__(self, index):
-        from irods.data_object import iRODSDataObject
-        from irods.models import Collection, DataObject, User
-        print(index)
-        if "COLL_ID" in str(index):
+        if index.icat_id == Collection.id.icat_id:
             return self.Collid
-        if "COLL_NAME" in str(index):
+        if index.icat_id == Collection.name.icat_id:
             return self.Collname
 
     def configure(self):
@@ -1182,17 +1396,17 @@ class MockiRODSSession(object):
         return self
 
     def get_results(self):
-        get_result_dict= iRodsResult('tests/', 'test.fasta.gz', 45, 'biomaj', '2017-04-10 00:00:00')
-        return [get_result_dict]
+        return list(self.RESULTS)
 
     def cleanup(self):
         return self
 
     def open(self,r):
-        my_test_file = open("tests/test.fasta.gz", "r+")
+        my_test_file = open(os.path.join(TESTS_DIR, "test.fasta.gz"), "r+")
         return(my_test_file)
 
 
+@pytest.mark.network
 @pytest.mark.skipif(
   os.environ.get('NETWORK', 1) == '0',
   reason='network tests disabled'
@@ -1205,14 +1419,20 @@ class TestBiomajIRODSDownload(unittest.TestCase):
     '''
     Test IRODS downloader
     '''
-    def setup_method(self, m):
-        self.utils = UtilsForTest()
-        self.curdir = os.path.dirname(os.path.realpath(__file__))
-        self.examples = os.path.join(self.curdir,'bank') + '/'
-        BiomajConfig.load_config(self.utils.global_properties, allow_user_config=False)
+    curdir = TESTS_DIR
+    examples = BANK_DIR + '/'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.utils = UtilsForTest()
+        BiomajConfig.load_config(cls.utils.global_properties, allow_user_config=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.utils.clean()
 
     def teardown_method(self, m):
-        self.utils.clean()
+        self.utils.clean_data()
 
     @patch('irods.session.iRODSSession.configure')
     @patch('irods.session.iRODSSession.query')
@@ -1227,6 +1447,7 @@ class TestBiomajIRODSDownload(unittest.TestCase):
         assert (len(files_list) != 0)
 
 
+@pytest.mark.network
 @pytest.mark.skipif(
   os.environ.get('NETWORK', 1) == '0',
   reason='network tests disabled'
@@ -1235,19 +1456,26 @@ class TestBiomajIRODSDownload(unittest.TestCase):
   os.environ.get('LOCAL_IRODS', 1) == '0',
   reason='irods tests disabled'
 )
+@pytest.mark.local_irods
 class TestBiomajLocalIRODSDownload(unittest.TestCase):
     """
     Test with a local iRODS server.
     """
 
-    def setup_method(self, m):
-        self.utils = UtilsForLocalIRODSTest()
-        self.curdir = os.path.dirname(os.path.realpath(__file__))
-        self.examples = os.path.join(self.curdir,'bank') + '/'
-        BiomajConfig.load_config(self.utils.global_properties, allow_user_config=False)
+    curdir = TESTS_DIR
+    examples = BANK_DIR + '/'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.utils = UtilsForLocalIRODSTest()
+        BiomajConfig.load_config(cls.utils.global_properties, allow_user_config=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.utils.clean()
 
     def teardown_method(self, m):
-        self.utils.clean()
+        self.utils.clean_data()
 
     def test_irods_download(self):
         irodsd = IRODSDownload(self.utils.SERVER, self.utils.COLLECTION)
@@ -1279,35 +1507,13 @@ class TestBiomajLocalIRODSDownload(unittest.TestCase):
         """
         Try to download fake files to test retry.
         """
-        n_attempts = 5
         irodsd = IRODSDownload(self.utils.SERVER, self.utils.COLLECTION)
         irodsd.set_options(dict(skip_check_uncompress=True))
         irodsd.set_param(dict(
             user=self.utils.USER,
             password=self.utils.PASSWORD,
         ))
-        # Download a fake file
-        irodsd.set_files_to_download([
-              {'name': 'TOTO.zip', 'year': '2016', 'month': '02', 'day': '19',
-               'size': 1, 'save_as': 'TOTO1KB'}
-        ])
-        irodsd.set_options(dict(stop_condition=tenacity.stop.stop_after_attempt(n_attempts),
-                                wait_condition=tenacity.wait.wait_none()))
-        with pytest.raises(Exception):
-          irodsd.download(self.utils.data_dir)
-
-        logging.debug(irodsd.retryer.statistics)
-        assert (len(irodsd.files_to_download) == 1)
-        assert (irodsd.retryer.statistics["attempt_number"] == n_attempts)
-        # Try to download another file to ensure that it retryies
-        irodsd.set_files_to_download([
-              {'name': 'TITI.zip', 'year': '2016', 'month': '02', 'day': '19',
-               'size': 1, 'save_as': 'TOTO1KB'}
-        ])
-        with pytest.raises(Exception):
-          irodsd.download(self.utils.data_dir)
-        assert (len(irodsd.files_to_download) == 1)
-        assert (irodsd.retryer.statistics["attempt_number"] == n_attempts)
+        check_download_retry(irodsd, self.utils.data_dir)
         irodsd.close()
 
     def test_irods_list_error(self):
@@ -1327,3 +1533,443 @@ class TestBiomajLocalIRODSDownload(unittest.TestCase):
         ))
         with pytest.raises(Exception):
           (file_list, dir_list) = irodsd.list()
+
+
+class TestDownloadService():
+  """
+  Test DownloadService with fakeredis and a mocked rabbitmq connection
+  """
+
+  @classmethod
+  def setup_class(cls):
+    cls.utils = UtilsForTest()
+
+  @classmethod
+  def teardown_class(cls):
+    cls.utils.clean()
+
+  def setup_method(self, m):
+    self.redis_server = fakeredis.FakeServer()
+    self.service = download_service(self.redis_server)
+
+  def teardown_method(self, m):
+    self.service.close()
+    self.utils.clean_data()
+
+  def test_instance_thread_state(self):
+    """
+    Publish lock and worker thread data are not shared between services
+    """
+    other_service = download_service(self.redis_server)
+    assert (other_service.publish_lock is not self.service.publish_lock)
+    assert (other_service.thread_data is not self.service.thread_data)
+
+  def test_process_message_thread_operation(self):
+    """
+    Each worker thread parses messages in its own Operation, reused for
+    the next messages
+    """
+    seen = []
+
+    def download(message):
+      seen.append((message.bank, self.service.thread_data.operation))
+      return []
+
+    self.service.download = download
+    for bank in ('bank1', 'bank2'):
+      self.service._process_message(download_operation(bank, 'session', self.utils.data_dir).SerializeToString())
+    worker = threading.Thread(
+      target=self.service._process_message,
+      args=(download_operation('bank3', 'session', self.utils.data_dir).SerializeToString(),)
+    )
+    worker.start()
+    worker.join()
+    assert ([bank for (bank, operation) in seen] == ['bank1', 'bank2', 'bank3'])
+    assert (seen[0][1] is seen[1][1])
+    assert (seen[2][1] is not seen[0][1])
+
+  def test_dispatch_to_workers(self):
+    """
+    Messages are processed in the worker pool, their acks are sent from
+    the connection thread, close() waits for the workers and sends them
+    """
+    self.service.config['rabbitmq']['consumer_threads'] = 2
+    self.service.config['rabbitmq']['ack_batch_size'] = 1
+    workers = []
+
+    def download(message):
+      workers.append(threading.current_thread())
+      return []
+
+    self.service.download = download
+    self.service.wait_for_messages()
+    self.service.channel.basic_consume.assert_called_once()
+    for tag in (1, 2, 3):
+      deliver(self.service, tag, download_operation('bank', 'session', self.utils.data_dir))
+    # Workers never use the channel
+    self.service.channel.basic_ack.assert_not_called()
+    self.service.close()
+    assert (self.service.executor is None)
+    assert (len(workers) == 3)
+    assert (threading.current_thread() not in workers)
+    acked = sorted(ack[1]['delivery_tag'] for ack in self.service.channel.basic_ack.call_args_list)
+    assert (acked == [1, 2, 3])
+    self.service.channel.close.assert_called()
+
+  def start_consuming(self, ack_batch_size, n_messages=4):
+    """
+    Consume n_messages with delivery tags 1 to n_messages, processing is
+    left to the test (see ManualExecutor)
+    """
+    self.service.config['rabbitmq']['ack_batch_size'] = ack_batch_size
+    with patch('biomaj_download.downloadservice.ThreadPoolExecutor', ManualExecutor):
+      self.service.wait_for_messages()
+    for tag in range(1, n_messages + 1):
+      deliver(self.service, tag, download_operation('bank', 'session', self.utils.data_dir))
+
+  def complete(self, *tags):
+    """
+    Complete the processing of messages and run their acks in the
+    connection thread
+    """
+    self.service.executor.complete(*tags)
+    self.service.connection.process_data_events()
+
+  def test_ack_out_of_order(self):
+    """
+    Batched acks never cover a message still being processed
+    """
+    self.start_consuming(ack_batch_size=2)
+    basic_ack = self.service.channel.basic_ack
+    # 2 is running, only 1 can be acked
+    self.complete(1, 3)
+    assert (basic_ack.call_args_list == [call(delivery_tag=1, multiple=True)])
+    # 2 is still running
+    self.complete(4)
+    assert (basic_ack.call_count == 1)
+    self.complete(2)
+    assert (basic_ack.call_args_list == [call(delivery_tag=1, multiple=True),
+                                         call(delivery_tag=4, multiple=True)])
+    assert (not self.service.connection.timeouts)
+
+  def test_ack_timer(self):
+    """
+    Incomplete batches are acked after ack_delay
+    """
+    self.start_consuming(ack_batch_size=4)
+    basic_ack = self.service.channel.basic_ack
+    self.complete(2)
+    assert (len(self.service.connection.timeouts) == 1)
+    # 1 is still running
+    self.service.connection.run_timeouts()
+    basic_ack.assert_not_called()
+    self.complete(1)
+    assert (len(self.service.connection.timeouts) == 1)
+    self.service.connection.run_timeouts()
+    assert (basic_ack.call_args_list == [call(delivery_tag=2, multiple=True)])
+    assert (self.service._ack_timer is None)
+
+  def test_ack_on_close(self):
+    """
+    close() waits for running messages and acks all of them
+    """
+    self.start_consuming(ack_batch_size=8)
+    self.service.executor.complete(1, 2)
+    self.service.close()
+    assert (self.service.channel.basic_ack.call_args_list == [call(delivery_tag=4, multiple=True)])
+    # Pending timer is cancelled
+    assert (not self.service.connection.timeouts)
+
+  def test_ack_batch_size_1(self):
+    """
+    Without batching, each message is acked once processed
+    """
+    self.start_consuming(ack_batch_size=1)
+    self.complete(2, 3, 1)
+    assert (self.service.channel.basic_ack.call_args_list == [call(delivery_tag=2),
+                                                              call(delivery_tag=3),
+                                                              call(delivery_tag=1)])
+    assert (not self.service.connection.timeouts)
+
+  def test_publish(self):
+    """
+    Without batching, messages are published without transaction
+    """
+    self.service.ask_download(download_operation('bank', 'session', self.utils.data_dir))
+    self.service.flush_publish()
+    assert (self.service.channel.basic_publish.call_count == 1)
+    self.service.channel.tx_select.assert_not_called()
+    self.service.channel.tx_commit.assert_not_called()
+
+  def test_publish_batch(self):
+    """
+    Messages are committed by batch, remaining ones by flush_publish()
+    """
+    channel = self.service.channel
+    self.service.set_publish_batch_size(3)
+    channel.tx_select.assert_called_once()
+    for _ in range(7):
+      self.service.ask_download(download_operation('bank', 'session', self.utils.data_dir))
+    assert (channel.basic_publish.call_count == 7)
+    assert (channel.tx_commit.call_count == 2)
+    self.service.flush_publish()
+    assert (channel.tx_commit.call_count == 3)
+    # Nothing left to commit
+    self.service.flush_publish()
+    assert (channel.tx_commit.call_count == 3)
+
+  def test_publish_batch_size_decrease(self):
+    """
+    Changing the batch size commits pending messages, batching cannot be
+    disabled
+    """
+    channel = self.service.channel
+    self.service.set_publish_batch_size(3)
+    for _ in range(2):
+      self.service.ask_download(download_operation('bank', 'session', self.utils.data_dir))
+    self.service.set_publish_batch_size(2)
+    assert (channel.tx_commit.call_count == 1)
+    with pytest.raises(ValueError):
+      self.service.set_publish_batch_size(1)
+    assert (self.service.publish_batch_size == 2)
+    for _ in range(2):
+      self.service.ask_download(download_operation('bank', 'session', self.utils.data_dir))
+    assert (channel.tx_commit.call_count == 2)
+    channel.tx_select.assert_called_once()
+
+  def test_session_no_ttl(self):
+    """
+    Sessions do not expire by default
+    """
+    session = self.service._create_session('bank')
+    session_key = self.service._session_key('bank', session)
+    assert (self.service.redis_client.ttl(session_key) == -1)
+
+  def test_refresh_session(self):
+    """
+    All session keys get session_ttl expiration
+    """
+    self.service.config['redis']['session_ttl'] = 100
+    session_key = self.service._session_key('bank', 'session')
+    redis_client = self.service.redis_client
+    for suffix in SESSION_KEY_SUFFIXES:
+      redis_client.set(session_key + suffix, 1)
+    pipeline = redis_client.pipeline()
+    self.service._refresh_session(pipeline, session_key)
+    pipeline.execute()
+    for suffix in SESSION_KEY_SUFFIXES:
+      assert (0 < redis_client.ttl(session_key + suffix) <= 100)
+
+  def test_status_refresh_session(self):
+    """
+    Status requests of a waiting client keep the session
+    """
+    self.service.config['redis']['session_ttl'] = 100
+    session = self.service._create_session('bank')
+    session_key = self.service._session_key('bank', session)
+    biomaj_file_info = download_operation('bank', session, self.utils.data_dir).download
+    redis_client = self.service.redis_client
+    redis_client.expire(session_key, 5)
+    assert (self.service.download_status(biomaj_file_info) == (-1, -1))
+    assert (redis_client.ttl(session_key) > 5)
+    redis_client.expire(session_key, 5)
+    assert (not self.service.list_status(biomaj_file_info))
+    assert (redis_client.ttl(session_key) > 5)
+
+  def test_download_end(self):
+    """
+    A successful download increments the session progress only
+    """
+    session = self.service._create_session('bank')
+    session_key = self.service._session_key('bank', session)
+    biomaj_file_info = download_operation('bank', session, self.utils.data_dir).download
+    downloaded_files = self.service.download(biomaj_file_info)
+    assert (len(downloaded_files) == 1)
+    assert (os.path.exists(os.path.join(self.utils.data_dir, 'test.fasta.gz')))
+    assert (self.service.download_status(biomaj_file_info) == (1, -1))
+    assert (not self.service.redis_client.exists(session_key + ':error:info'))
+    # session_ttl 0, no expiration
+    assert (self.service.redis_client.ttl(session_key + ':progress') == -1)
+
+  def test_download_end_error(self):
+    """
+    A failed download increments progress and errors, and records the error
+    """
+    self.service.config['redis']['session_ttl'] = 100
+    session = self.service._create_session('bank')
+    session_key = self.service._session_key('bank', session)
+    biomaj_file_info = download_operation('bank', session, self.utils.data_dir).download
+    with patch.object(self.service, 'local_download', side_effect=Exception('download failed')):
+      assert (self.service.download(biomaj_file_info) == [])
+    assert (self.service.download_status(biomaj_file_info) == (1, 1))
+    for suffix in ('', ':error', ':progress', ':error:info'):
+      assert (0 < self.service.redis_client.ttl(session_key + suffix) <= 100)
+    assert (self.service.download_errors(biomaj_file_info) == ['download failed'])
+
+  def test_download_end_max_errors(self):
+    """
+    Only the last MAX_SESSION_ERRORS error messages are kept
+    """
+    session = self.service._create_session('bank')
+    biomaj_file_info = download_operation('bank', session, self.utils.data_dir).download
+    n_errors = MAX_SESSION_ERRORS + 5
+    with patch.object(self.service, 'local_download',
+                      side_effect=[Exception('error %d' % i) for i in range(n_errors)]):
+      for _ in range(n_errors):
+        self.service.download(biomaj_file_info)
+    assert (self.service.download_status(biomaj_file_info) == (n_errors, n_errors))
+    assert (self.service.download_errors(biomaj_file_info) == ['error %d' % i for i in range(5, n_errors)])
+
+  def test_download_end_session_cleaned(self):
+    """
+    Downloads ending after their session was cleaned are not recorded
+    """
+    session = self.service._create_session('bank')
+    session_key = self.service._session_key('bank', session)
+    biomaj_file_info = download_operation('bank', session, self.utils.data_dir).download
+
+    def local_download(biomaj_file_info):
+      self.service.clean(biomaj_file_info)
+      return []
+
+    with patch.object(self.service, 'local_download', side_effect=local_download):
+      self.service.download(biomaj_file_info)
+    for suffix in SESSION_KEY_SUFFIXES:
+      assert (not self.service.redis_client.exists(session_key + suffix))
+
+  def test_download_errors(self):
+    """
+    Errors are returned oldest first, as with the previous RPOP loop, and
+    consumed
+    """
+    session = self.service._create_session('bank')
+    session_key = self.service._session_key('bank', session)
+    biomaj_file_info = download_operation('bank', session, self.utils.data_dir).download
+    # Errors are pushed on the left
+    for error in ('error 1', 'error 2', 'error 3'):
+      self.service.redis_client.lpush(session_key + ':error:info', error)
+    assert (self.service.download_errors(biomaj_file_info) == ['error 1', 'error 2', 'error 3'])
+    assert (not self.service.redis_client.exists(session_key + ':error:info'))
+    assert (self.service.download_errors(biomaj_file_info) == [])
+
+  def list_operation(self, session):
+    """
+    DownloadFile message of a list operation on BANK_DIR
+    """
+    operation = download_operation('bank', session, self.utils.data_dir)
+    operation.type = 0
+    biomaj_file_info = operation.download
+    del biomaj_file_info.remote_file.files[:]
+    biomaj_file_info.remote_file.matches.append(r'^test.*\.gz$')
+    return biomaj_file_info
+
+  def test_list_result(self):
+    """
+    A list stored by list() is read back by list_result() and the web
+    endpoint
+    """
+    session = self.service._create_session('bank')
+    biomaj_file_info = self.list_operation(session)
+    self.service.list(biomaj_file_info)
+    assert (self.service.list_status(biomaj_file_info))
+    file_list = self.service.list_result(biomaj_file_info)
+    assert ([remote_file.name for remote_file in file_list.files] == ['test.fasta.gz'])
+    assert (file_list.files[0].metadata.size == os.path.getsize(os.path.join(BANK_DIR, 'test.fasta.gz')))
+    serialized = self.service.list_result(biomaj_file_info, protobuf_decode=False)
+    assert (serialized == file_list.SerializeToString())
+
+    # The web module reads its configuration at import
+    with patch.dict(os.environ, {'BIOMAJ_CONFIG': SERVICE_CONFIG}):
+      from biomaj_download import biomaj_download_web
+    web_client = biomaj_download_web.app.test_client()
+    url = '/api/download/list/bank/' + session
+    with patch('redis.StrictRedis', functools.partial(fakeredis.FakeStrictRedis, server=self.redis_server)):
+      response = web_client.get(url)
+      raw_response = web_client.get(url, headers={'Accept': 'application/x-protobuf'})
+    assert (base64.b64decode(json.loads(response.data)['files']) == serialized)
+    assert (raw_response.mimetype == 'application/x-protobuf')
+    assert (raw_response.data == serialized)
+
+  def test_list_result_previous_format(self):
+    """
+    Lists stored as str() of the serialized FileList by previous versions
+    are still read
+    """
+    session = self.service._create_session('bank')
+    biomaj_file_info = self.list_operation(session)
+    file_list = downmessage_pb2.FileList()
+    remote_file = file_list.files.add()
+    remote_file.name = 'test.fasta.gz'
+    remote_file.root = BANK_DIR
+    self.service.redis_client.set(self.service._session_key('bank', session) + ':files',
+                                  str(file_list.SerializeToString()))
+    assert (self.service.list_result(biomaj_file_info) == file_list)
+    assert (self.service.list_result(biomaj_file_info, protobuf_decode=False) == file_list.SerializeToString())
+
+  def test_list_result_none(self):
+    session = self.service._create_session('bank')
+    assert (self.service.list_result(self.list_operation(session)) is None)
+
+
+class TestDownloadClient():
+  """
+  Test DownloadClient in remote mode, with a mocked rabbitmq connection and
+  download proxy
+  """
+
+  def setup_method(self, m):
+    self.client = remote_download_client()
+
+  def test_remote_download(self):
+    """
+    Downloads are published to rabbitmq, then the client waits for them
+    """
+    for name in ('test.fasta.gz', 'test2.fasta'):
+      self.client.download_remote_file(download_operation('bank', 'session', '/tmp', name=name))
+    assert (self.client.channel.basic_publish.call_count == 2)
+    with patch.object(self.client, 'download_status', return_value=(2, 0)):
+      assert (not self.client.wait_for_download())
+    self.client.channel.tx_commit.assert_not_called()
+
+  def test_remote_download_batch(self):
+    """
+    With batched publishing, wait_for_download() commits pending messages
+    """
+    channel = self.client.channel
+    self.client.set_publish_batch_size(3)
+    channel.tx_select.assert_called_once()
+    for _ in range(5):
+      self.client.download_remote_file(download_operation('bank', 'session', '/tmp'))
+    assert (channel.basic_publish.call_count == 5)
+    assert (channel.tx_commit.call_count == 1)
+    with patch.object(self.client, 'download_status', return_value=(5, 0)):
+      assert (not self.client.wait_for_download())
+    assert (channel.tx_commit.call_count == 2)
+    assert (self.client.publish_pending == 0)
+
+  def test_concurrent_publish(self):
+    """
+    Threads sharing the client channel publish one message at a time
+    """
+    publishing = []
+    overlaps = []
+
+    def basic_publish(**kwargs):
+      publishing.append(threading.current_thread())
+      if len(publishing) > 1:
+        overlaps.append(len(publishing))
+      time.sleep(0.01)
+      publishing.pop()
+
+    self.client.channel.basic_publish.side_effect = basic_publish
+    publishers = [
+      threading.Thread(target=self.client.ask_download,
+                       args=(download_operation('bank', 'session', '/tmp'),))
+      for _ in range(4)
+    ]
+    for publisher in publishers:
+      publisher.start()
+    for publisher in publishers:
+      publisher.join()
+    assert (self.client.channel.basic_publish.call_count == 4)
+    assert (not overlaps)